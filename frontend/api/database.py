@@ -1,42 +1,237 @@
 import json
-import time
 
 import numpy as np
 import flask
 from flask import jsonify, request
 
+from api.jobs import queued_response
+from embedding.pipeline import BackfillPipeline, missing_only
+from embedding.sharded import run_sharded_backfill
+from jobs.neighbours import refresh_neighbours
+from storage.ann_store import AnnStore
+from storage.embed_format import FORMATS
+from storage.matrix_store import MatrixStore
 from storage.neo4j_store import Neo4jStore
 from storage.postgres_store import PostgresStore
+from storage.result_cache import EPOCH_KEY, ResultCache
 
 
-def register_database_endpoints(app, stores, mod):
+def register_database_endpoints(app, stores, encoder, config, jobs, prewarmer):
     store_neo4j: Neo4jStore = stores["neo4j"]
     store_postgres: PostgresStore = stores["postgres"]
+    store_ann: AnnStore = stores["ann"]
+    store_matrix: MatrixStore = stores["matrix"]
+    store_results: ResultCache = stores["results"]
 
     @app.route("/db/init/postgres")
     def create_postgres_tables():
         store_postgres.create_embed_table()
+        store_postgres.create_title_embed_table()
+        store_postgres.create_checkpoint_table()
+        store_postgres.create_job_table()
+        store_postgres.create_neighbour_table()
         return jsonify({"state": "SUCCESS"})
 
-    @app.route("/db/init/embed")
-    def generate_all_embeds():
+    def backfill_embeds(job, mode="all", resume=True, batchsize=10000, workers=None):
+        """
+        Backfills sentence embeddings for publications with title.
+
+          - mode: "all" (default) encodes every title, "missing" encodes only
+            the publications that do not have an embedding yet.
+          - resume: if true (default), continues after the key checkpointed by
+            a previous run that did not finish.
+          - batchsize: number of publications per batch.
+          - workers: if larger than 1, the key space is split over this many
+            worker processes, each with its own encoder (see
+            embedding.sharded). Checkpoints are not used in this case; use
+            mode=missing to continue an interrupted run.
+        """
+        workers = int(workers or config.get("EMBED_WORKERS", 1))
+        resume = str(resume).lower() != "false"
+        batchsize = int(batchsize)
+        checkpoint = f"embed_{mode}"
+
+        if mode not in ("all", "missing"):
+            raise ValueError(f"Unknown mode {mode}")
+
         num_publ = store_neo4j.get_num_publications_with_title()
         app.logger.info(f"Total {num_publ} publications with title")
-        batchsize = 10000
+        # The number of missing embeddings is not known up front
+        total = num_publ if mode == "all" else None
+        job.progress(0, total, force=True)
+
+        if workers > 1:
+            stats = run_sharded_backfill(
+                store_neo4j,
+                num_workers=workers,
+                intra_op_threads=config.get("EMBED_INTRA_OP_THREADS"),
+                batchsize=batchsize,
+                missing_only=mode == "missing",
+                logger=app.logger,
+                progress=job.progress,
+            )
+            errors = [s["error"] for s in stats["shards"] if s["error"]]
+            if errors:
+                raise RuntimeError("\n".join(errors))
+            store_results.bump_epoch()
+            return stats
+
+        after = (store_postgres.get_checkpoint(checkpoint) if resume else None) or ""
+        if after:
+            app.logger.info(f"Resuming {checkpoint} after {after}")
 
-        for i in range(0, num_publ, batchsize):
-            time_start = time.time()
-            result = store_neo4j.get_pkeys_and_titles_of(i, i + batchsize)
+        batches = store_neo4j.iter_pkeys_and_titles(batchsize, after=after)
+        if mode == "missing":
+            batches = missing_only(batches, store_postgres)
+
+        def write(pkeys, embeds):
+            # Fail the job so that the checkpoint stays before the lost batch
+            if not store_postgres.insert_pkeys_embeds(pkeys, embeds):
+                raise RuntimeError(f"Failed to write batch ending at {pkeys[-1]}")
+            store_postgres.set_checkpoint(checkpoint, pkeys[-1])
+
+        pipeline = BackfillPipeline(
+            batches,
+            encode=encoder,
+            write=write,
+            logger=app.logger,
+            progress=job.progress,
+        )
+        stats = pipeline.run()
+        store_postgres.clear_checkpoint(checkpoint)
+        store_results.bump_epoch()
+
+        return {"resumed_after": after, "stats": stats}
+
+    jobs.register("embed", backfill_embeds)
+
+    @app.route("/db/init/embed")
+    def generate_all_embeds():
+        job_id = jobs.submit("embed", **request.args.to_dict())
+        return queued_response(job_id)
 
-            pkeys = list(map(lambda x: x["pkey"], result))
-            titles = list(map(lambda x: x["title"], result))
-            embeds = np.array(mod(titles)).tolist()
-            app.logger.info(f"({i}, {i + batchsize}): Done making embedding")
+    def migrate_embeds(job, format=None, normalize="false", batchsize=10000):
+        total = store_postgres.count_embeds()
+        job.progress(0, total, force=True)
+        count = store_postgres.migrate_embed_format(
+            format,
+            batchsize=int(batchsize),
+            progress=lambda n: job.progress(n, max(n, total)),
+            normalize=normalize.lower() == "true",
+        )
+        return {
+            "format": store_postgres.embed_format,
+            "normalized": store_postgres.embeds_normalized,
+            "rows": count,
+        }
 
-            store_postgres.insert_pkeys_embeds(pkeys, embeds)
-            time_end = time.time()
-            app.logger.info(
-                f"({i}, {i + batchsize}): Done {time_end - time_start:.3f}sec"
+    jobs.register("migrate_embeds", migrate_embeds)
+
+    @app.route("/db/migrate/embed")
+    def migrate_embed_format():
+        """
+        Rewrites the embeds table, e.g. /db/migrate/embed?format=int8 to change
+        the storage format or /db/migrate/embed?normalize=true to normalize the
+        vectors of a table written before normalization at write time.
+        """
+        fmt = request.args.get("format", None)
+        if fmt is not None and fmt not in FORMATS:
+            return (
+                jsonify(
+                    {"state": "FAILURE", "error": f"format must be one of {FORMATS}"}
+                ),
+                400,
             )
 
-        return jsonify({"state": "SUCCESS"})
+        job_id = jobs.submit("migrate_embeds", **request.args.to_dict())
+        return queued_response(job_id)
+
+    def build_ann(job, nlist=None):
+        count = store_ann.build(
+            store_postgres,
+            nlist=int(nlist) if nlist else None,
+            progress=job.progress,
+        )
+        job.progress(count, count, force=True)
+        return {"rows": count, **store_ann.stats()}
+
+    jobs.register("build_ann", build_ann)
+
+    @app.route("/db/init/ann")
+    def build_ann_index():
+        """
+        Rebuilds the ANN index from the embeds table; /db/init/ann?nlist=4096
+        overrides the number of lists (4 * sqrt(rows) by default).
+        """
+        job_id = jobs.submit("build_ann", **request.args.to_dict())
+        return queued_response(job_id)
+
+    def export_embeds(job):
+        count = store_matrix.export(store_postgres, progress=job.progress)
+        job.progress(count, count, force=True)
+        return store_matrix.stats()
+
+    jobs.register("export_embeds", export_embeds)
+
+    @app.route("/db/export/embed")
+    def export_embed_matrix():
+        """
+        Writes a new memory-mapped snapshot of the embeds table for serving;
+        run again after bulk loads to refresh it.
+        """
+        job_id = jobs.submit("export_embeds")
+        return queued_response(job_id)
+
+    def refresh_neighbour_table(job, k=None, workers=4, if_computed=False):
+        """
+        Precomputes the top k neighbours of every publication and marks the
+        table fresh for the data epoch it was computed from. Communities are
+        detected anew on every change of the graph, so only a full refresh
+        can make the table fresh again. With ``if_computed`` (after an
+        upload), the table is only refreshed if it was computed before, with
+        the same k by default.
+        """
+        store_postgres.create_meta_table()
+        store_postgres.create_neighbour_table()
+        epoch = int(store_postgres.get_meta(EPOCH_KEY) or 0)
+        fresh_k = store_postgres.get_meta("neighbours.k")
+
+        if str(if_computed).lower() == "true":
+            if fresh_k is None:
+                return {"skipped": "the neighbour table was never computed"}
+            k = k or fresh_k
+        k = int(k or config.get("NEIGHBOURS_K", 25))
+        communities = store_neo4j.get_community_sizes()
+
+        # Rows are replaced in place, so the table is not used meanwhile
+        store_postgres.set_meta("neighbours.epoch", "")
+        count = refresh_neighbours(
+            store_neo4j,
+            store_postgres,
+            communities,
+            k,
+            ensure_graph=prewarmer.ensure,
+            workers=int(workers),
+            progress=job.progress,
+        )
+
+        # If the data changed meanwhile, the epoch is already outdated
+        store_postgres.set_meta("neighbours.k", str(k))
+        store_postgres.set_meta("neighbours.epoch", str(epoch))
+        return {
+            "communities": len(communities),
+            "publications": count,
+            "k": k,
+            "fresh_epoch": epoch,
+        }
+
+    jobs.register("neighbours", refresh_neighbour_table)
+
+    @app.route("/db/init/neighbours")
+    def build_neighbour_table():
+        """
+        Recomputes the neighbour table read by /recommend, e.g.
+        /db/init/neighbours?k=25&workers=4.
+        """
+        job_id = jobs.submit("neighbours", **request.args.to_dict())
+        return queued_response(job_id)
@@ -0,0 +1,36 @@
+import time
+
+from flask import jsonify
+
+from embedding.model import ModelNotReady
+
+
+def register_encoder_endpoints(app, model, service, started_at):
+    first_request = {}
+
+    @app.before_request
+    def record_first_request():
+        if not first_request:
+            first_request["sec"] = time.time() - started_at
+            app.logger.info(f"First request {first_request['sec']:.3f}sec after start")
+
+    @app.errorhandler(ModelNotReady)
+    def model_not_ready(e):
+        response = jsonify({"state": "FAILURE", "error": str(e)})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+
+    @app.route("/api/encoder/stats", methods=["GET"])
+    def get_encoder_stats():
+        return jsonify({"model": model.stats(), "service": service.stats()})
+
+    @app.route("/api/status", methods=["GET"])
+    def get_status():
+        return jsonify(
+            {
+                "uptime_sec": round(time.time() - started_at, 3),
+                "time_to_first_request_sec": first_request.get("sec"),
+                "model_ready": model.ready,
+                "model_load_sec": model.load_sec,
+            }
+        )
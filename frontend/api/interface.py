@@ -1,11 +1,25 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import flask
 from flask import jsonify, request
 
+from embedding.similarity import rank_by_similarity
+
 
-def register_interface_endpoints(app, stores):
+def register_interface_endpoints(app, stores, config, prewarmer):
     store_neo4j = stores["neo4j"]
     store_postgres = stores["postgres"]
+    store_ann = stores["ann"]
+    store_matrix = stores["matrix"]
+    store_results = stores["results"]
+
+    # Runs the independent store calls of /recommend concurrently
+    executor = ThreadPoolExecutor(
+        max_workers=config.get("RECOMMEND_WORKERS", 8),
+        thread_name_prefix="recommend",
+    )
 
     @app.template_filter()
     def numberFormat(value):
@@ -66,8 +80,155 @@ def register_interface_endpoints(app, stores):
             data=data,
         )
 
-    def cosine_sim(x, y):
-        return np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y))
+    def retrieve_embed_matrix(pkeys):
+        """
+        Reads vectors from the memory-mapped snapshot; keys written after the
+        last export are read from Postgres.
+        """
+        keys, embeds = store_matrix.retrieve_embed_matrix(pkeys)
+        missing = list(set(pkeys).difference(keys))
+        if missing:
+            keys_missing, embeds_missing = store_postgres.retrieve_embed_matrix(missing)
+            keys = np.concatenate([keys, keys_missing])
+            embeds = np.concatenate([embeds, embeds_missing])
+        return keys, embeds
+
+    def timed(timings, stage, fn, *args, **kwargs):
+        time_start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] = time.perf_counter() - time_start
+
+    def score_candidates(pkey, embed_target, pkeys, k):
+        # In the database if the embeds table is in the vector format
+        if store_postgres.embed_format == "vector":
+            return store_postgres.nearest(pkey, k, within=pkeys)
+
+        keys_embeds, embeds = retrieve_embed_matrix(pkeys)
+        return rank_by_similarity(
+            embed_target,
+            keys_embeds,
+            embeds,
+            k,
+            normalized=store_postgres.embeds_normalized,
+        )
+
+    def recommend_precomputed(pkey, neighbours, timings):
+        """Builds the recommendations from rows of the neighbour table."""
+        res = timed(
+            timings,
+            "details",
+            store_neo4j.search_by_pkey,
+            [pkey] + [x["pkey"] for x in neighbours],
+        )
+        dict_publ = {x["p"]["key"]: x for x in serialize_search_data(res)}
+
+        data_recom = []
+        for x in neighbours:
+            if x["pkey"] in dict_publ:
+                data = dict_publ[x["pkey"]]
+                data["content_similarity"] = x["content_similarity"]
+                data["node_similarity"] = x["node_similarity"]
+                data_recom.append(data)
+
+        return dict_publ[pkey], data_recom, True
+
+    def recommend(pkey, k, source, epoch, timings):
+        """
+        Returns the target publication and its top k recommendations. Store
+        calls that do not depend on each other run concurrently: the target
+        embedding alongside the graph lookup, then the details of candidates
+        not returned by the graph lookup alongside the scoring of the
+        candidates. The duration of each stage is written to ``timings``.
+
+        Graph recommendations are read from the neighbour table instead if it
+        is fresh for data ``epoch``.
+        """
+        if source == "graph":
+            neighbours = timed(
+                timings, "neighbours", store_postgres.get_neighbours, pkey, k, epoch
+            )
+            if neighbours is not None:
+                return recommend_precomputed(pkey, neighbours, timings)
+
+        future_embed = executor.submit(
+            timed, timings, "target_embed", retrieve_embed_matrix, [pkey]
+        )
+        # The target, its SIMILAR neighbours and their details in one query
+        if source in ("graph", "both"):
+            future_target = executor.submit(
+                timed,
+                timings,
+                "graph_context",
+                store_neo4j.get_recommendation_context,
+                pkey,
+                k,
+            )
+        else:
+            future_target = executor.submit(
+                timed, timings, "target", store_neo4j.search_by_pkey, [pkey]
+            )
+
+        # Generate candidates
+        res_target, res_recom, dict_cand = future_target.result(), [], {}
+        complete = True
+        if source in ("graph", "both"):
+            context = res_target
+            res_target = [context] if context else []
+            # SIMILAR relationships outlive the projection of the community
+            if context and context["similar_written"]:
+                res_recom = context["candidates"]
+                dict_cand = {x["p"]["key"]: x["node_similarity"] for x in res_recom}
+            elif context:
+                # Graphs are only built in the background; until they are
+                # written, only ANN candidates are shown (and not cached)
+                prewarmer.request(context["community_id"])
+                complete = False
+                if store_ann.is_ready:
+                    source = "both"
+
+        _, embed_target = future_embed.result()
+        embed_target = embed_target[0]
+        if source in ("ann", "both"):
+            keys_ann, _ = timed(
+                timings,
+                "ann_candidates",
+                store_ann.search,
+                embed_target,
+                k,
+                exclude=[pkey],
+            )
+            for _pkey in keys_ann:
+                dict_cand.setdefault(_pkey, None)
+
+        # Calculate content similarity while paper information is retrieved
+        pkeys = list(dict_cand)
+        known = {x["p"]["key"] for x in res_recom}
+        missing = [_pkey for _pkey in pkeys if _pkey not in known]
+        future_recom = None
+        if missing:
+            future_recom = executor.submit(
+                timed, timings, "candidate_details", store_neo4j.search_by_pkey, missing
+            )
+        keys_top, sims_top = timed(
+            timings, "scoring", score_candidates, pkey, embed_target, pkeys, k
+        )
+
+        data_target = serialize_search_data(res_target)[0]
+        if future_recom is not None:
+            res_recom = res_recom + future_recom.result()
+        dict_recom = {x["p"]["key"]: x for x in serialize_search_data(res_recom)}
+
+        data_recom = []
+        for _pkey, sim in zip(keys_top, sims_top):
+            if _pkey in dict_recom:
+                data = dict_recom[_pkey]
+                data["content_similarity"] = float(sim)
+                data["node_similarity"] = dict_cand[_pkey]
+                data_recom.append(data)
+
+        return data_target, data_recom, complete
 
     @app.route("/recommend", methods=["GET"])
     def get_recommendations_interface():
@@ -75,42 +236,55 @@ def register_interface_endpoints(app, stores):
         if pkey is None:
             return flask.redirect(flask.url_for("index"))
 
-        k = request.args.get("k", 25)
-
-        # Retrieve data for the target publication
-        res_target = store_neo4j.search_by_pkey([pkey])
-        data_target = serialize_search_data(res_target)[0]
-        embed_target = store_postgres.retrieve_embeds(pkey)[0][1]
-
-        # Generate candidates
-        res_cand = store_neo4j.generate_candidates(pkey, k)
-        dict_cand = {x["pkey"]: x["node_similarity"] for x in res_cand}
+        k = request.args.get("k", 25, type=int)
 
-        # Retrieve sentence embeddings
-        pkeys = list(map(lambda x: x["pkey"], res_cand))
-        res_embeds = store_postgres.retrieve_embeds(pkeys)
-        dict_embeds = {x[0]: x[1] for x in res_embeds}
+        # Candidates come from the co-authorship graph ("graph"), the ANN
+        # index over title embeddings ("ann") or both
+        source = request.args.get("source", "graph")
+        if source not in ("graph", "ann", "both"):
+            return jsonify({"error": "source must be graph, ann or both"}), 400
+        if not store_ann.is_ready:
+            source = "graph"
 
-        # Prepare paper information
-        res_recom = store_neo4j.search_by_pkey(pkeys)
-        data_recom = serialize_search_data(res_recom)
+        # Results only change with the data, see ResultCache
+        timings = {}
+        time_start = time.perf_counter()
+        epoch = store_results.epoch
+        cache_key = f"recommend:{pkey}:{k}:{source}"
+        result = timed(timings, "cache", store_results.get, cache_key, epoch)
+        if result is None:
+            result = recommend(pkey, k, source, epoch, timings)
+            if result[2]:
+                store_results.put(cache_key, result, epoch)
+        data_target, data_recom, complete = result
+        timings["total"] = time.perf_counter() - time_start
 
-        # Calculate content similarity
-        for i in range(len(data_recom)):
-            _pkey = data_recom[i]["p"]["key"]
-            _embed = dict_embeds.get(_pkey, None)
+        app.logger.debug(
+            f"/recommend {pkey}: "
+            + ", ".join(f"{stage} {1000 * t:.1f}ms" for stage, t in timings.items())
+        )
+        response = flask.make_response(
+            flask.render_template(
+                "recommend.jinja",
+                pkey=pkey,
+                data_target=data_target,
+                data_recom=data_recom,
+                graph_pending=not complete,
+            )
+        )
+        response.headers["Server-Timing"] = ", ".join(
+            f"{stage};dur={1000 * t:.2f}" for stage, t in timings.items()
+        )
+        return response
 
-            if _embed is not None:
-                data_recom[i]["content_similarity"] = cosine_sim(embed_target, _embed)
-                data_recom[i]["node_similarity"] = dict_cand[_pkey]
+    @app.route("/api/prewarm/stats", methods=["GET"])
+    def get_prewarm_stats():
+        return jsonify(prewarmer.stats())
 
-        # Filter and re-sort data
-        data_recom = list(filter(lambda x: "content_similarity" in x, data_recom))
-        data_recom.sort(key=lambda x: -x["content_similarity"])
+    @app.route("/api/gds/stats", methods=["GET"])
+    def get_gds_stats():
+        return jsonify(store_neo4j.projection_stats())
 
-        return flask.render_template(
-            "recommend.jinja",
-            pkey=pkey,
-            data_target=data_target,
-            data_recom=data_recom,
-        )
+    @app.route("/api/cache/stats", methods=["GET"])
+    def get_cache_stats():
+        return jsonify(store_results.stats())
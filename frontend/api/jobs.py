@@ -0,0 +1,32 @@
+from flask import jsonify, request
+
+from jobs.runner import JobRunner
+
+
+def queued_response(job_id):
+    return jsonify({"state": "QUEUED", "job_id": job_id, "url": f"/jobs/{job_id}"}), 202
+
+
+def register_job_endpoints(app, runner: JobRunner):
+    @app.route("/jobs/<string:kind>", methods=["POST"])
+    def submit_job(kind):
+        if kind not in runner.kinds or kind in runner.internal:
+            return jsonify({"state": "FAILURE", "error": f"Unknown job {kind}"}), 404
+
+        params = request.get_json(silent=True) or request.args.to_dict()
+        job_id = runner.submit(kind, **params)
+        return queued_response(job_id)
+
+    @app.route("/jobs/<int:job_id>", methods=["GET"])
+    def get_job(job_id):
+        job = runner.get(job_id)
+        if job is None:
+            return jsonify({"state": "FAILURE", "error": "Job not found"}), 404
+        return jsonify(job)
+
+    @app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+    @app.route("/jobs/<int:job_id>", methods=["DELETE"])
+    def cancel_job(job_id):
+        if not runner.cancel(job_id):
+            return jsonify({"state": "FAILURE", "error": "Job is not active"}), 409
+        return jsonify({"state": "CANCEL_REQUESTED", "job_id": job_id})
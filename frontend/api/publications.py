@@ -1,4 +1,5 @@
 import os
+import shutil
 import tempfile
 import subprocess
 
@@ -7,10 +8,17 @@ import flask
 from flask import jsonify, request
 from werkzeug.utils import secure_filename
 
+from api.jobs import queued_response
 
-def register_publication_endpoints(app, stores, mod, config):
+# Prefix of the temporary directories of uploaded files
+UPLOAD_DIR_PREFIX = "upload-"
+
+
+def register_publication_endpoints(app, stores, encoder, config, jobs, prewarmer):
     store_neo4j = stores["neo4j"]
     store_postgres = stores["postgres"]
+    store_ann = stores["ann"]
+    store_results = stores["results"]
 
     @app.route("/api/publ", methods=["GET"])
     def search_by_title():
@@ -42,9 +50,7 @@ def register_publication_endpoints(app, stores, mod, config):
             "./bin/dblp.dtd",
         ]
 
-        res = subprocess.run(
-            " ".join(args), shell=True, check=True, capture_output=True
-        )
+        res = subprocess.run(args, check=True, capture_output=True)
         stdout = res.stdout.decode("UTF-8").strip()
         pkeys = [s.strip() for s in stdout.split("\n")]
         return pkeys
@@ -52,19 +58,59 @@ def register_publication_endpoints(app, stores, mod, config):
     def _make_embed(res):
         pkeys = list(map(lambda x: x["pkey"], res))
         titles = list(map(lambda x: x["title"], res))
-        embeds = np.array(mod(titles)).tolist()
+        embeds = encoder(titles)
         store_postgres.insert_pkeys_embeds(pkeys, embeds)
+        store_ann.add(pkeys, embeds)
 
-    def _upload_data(filepath, config):
-        pkeys = _parse_and_upload_data(filepath, config)
-
+    def _reset_graph(job, done=0, steps=3):
         store_neo4j.drop_graphs()
+        job.progress(done + 1, steps)
         store_neo4j.drop_similar_relationships()
+        job.progress(done + 2, steps)
 
         node_count, rel_count, community_count = store_neo4j.create_community_graph()
+        prewarmer.schedule_all()
+        job.progress(done + 3, steps, force=True)
+
+        return node_count, rel_count, community_count
+
+    def upload_dirname(filepath):
+        """
+        Returns the temporary directory of an uploaded file, or None unless
+        ``filepath`` is a file directly inside a directory created by
+        upload_data_interface.
+        """
+        filepath = os.path.realpath(filepath)
+        dirname = os.path.dirname(filepath)
+        if (
+            os.path.dirname(dirname) == os.path.realpath(tempfile.gettempdir())
+            and os.path.basename(dirname).startswith(UPLOAD_DIR_PREFIX)
+            and os.path.isfile(filepath)
+            and is_file_allowed(filepath)
+        ):
+            return dirname
+        return None
+
+    def _upload_data(job, filepath):
+        tmpdirname = upload_dirname(filepath)
+        if tmpdirname is None:
+            raise ValueError(f"Not an uploaded file: {filepath}")
+
+        try:
+            job.progress(0, 5, force=True)
+            pkeys = _parse_and_upload_data(filepath, config)
+            job.progress(1, 5)
+        finally:
+            shutil.rmtree(tmpdirname, ignore_errors=True)
+
+        node_count, rel_count, community_count = _reset_graph(job, done=1, steps=5)
 
         res = store_neo4j.get_titles(pkeys)
         _make_embed(res)
+        store_results.bump_epoch()
+        # Communities were detected anew, so every neighbour list may change
+        jobs.submit("neighbours", if_computed=True)
+        job.progress(5, 5, force=True)
 
         return {
             "pkeys": pkeys,
@@ -73,12 +119,9 @@ def register_publication_endpoints(app, stores, mod, config):
             "community_count": community_count,
         }
 
-    @app.route("/db/init/reset_graph", methods=["GET"])
-    def reset_graph():
-        store_neo4j.drop_graphs()
-        store_neo4j.drop_similar_relationships()
-
-        node_count, rel_count, community_count = store_neo4j.create_community_graph()
+    def _reset_graph_job(job):
+        node_count, rel_count, community_count = _reset_graph(job)
+        store_results.bump_epoch()
 
         return {
             "node_count": node_count,
@@ -86,6 +129,14 @@ def register_publication_endpoints(app, stores, mod, config):
             "community_count": community_count,
         }
 
+    jobs.register("reset_graph", _reset_graph_job)
+    # Takes a server-side path, so it is only submitted by /upload
+    jobs.register("upload", _upload_data, internal=True)
+
+    @app.route("/db/init/reset_graph", methods=["GET"])
+    def reset_graph():
+        return queued_response(jobs.submit("reset_graph"))
+
     @app.route("/upload", methods=["GET", "POST"])
     def upload_data_interface():
         if request.method == "POST":
@@ -103,13 +154,12 @@ def register_publication_endpoints(app, stores, mod, config):
             app.logger.info(is_file_allowed(filename))
 
             if file and is_file_allowed(filename):
-                with tempfile.TemporaryDirectory() as tmpdirname:
-                    filepath = os.path.join(tmpdirname, filename)
-                    file.save(filepath)
-
-                    res = _upload_data(filepath, config)
+                # The upload job owns (and removes) the temporary directory
+                tmpdirname = tempfile.mkdtemp(prefix=UPLOAD_DIR_PREFIX)
+                filepath = os.path.join(tmpdirname, filename)
+                file.save(filepath)
 
-                return jsonify({"result": res})
+                return queued_response(jobs.submit("upload", filepath=filepath))
 
         return flask.render_template("upload.jinja")
 
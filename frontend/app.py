@@ -1,13 +1,28 @@
+import time
+
+# Measured before the remaining imports to report start-up time
+started_at = time.time()
+
 import os
 
 import flask
-import tensorflow as tf
-import tensorflow_hub as hub
 
 from config import load_config
+from embedding.batching import BucketedEncoder
+from embedding.cache import CachedEncoder
+from embedding.model import BackgroundModel, load_model
+from embedding.service import EncoderService
+from jobs.prewarm import SimilarityGraphPrewarmer
+from jobs.runner import JobRunner
+from jobs.singleflight import SingleFlight
+from storage.ann_store import AnnStore
+from storage.matrix_store import MatrixStore
 from storage.neo4j_store import Neo4jStore
 from storage.postgres_store import PostgresStore
+from storage.result_cache import ResultCache
 from api.database import register_database_endpoints
+from api.encoder import register_encoder_endpoints
+from api.jobs import register_job_endpoints
 from api.interface import register_interface_endpoints
 from api.publications import register_publication_endpoints
 
@@ -16,16 +31,59 @@ config = load_config()
 stores = {
     "neo4j": Neo4jStore(config),
     "postgres": PostgresStore(config),
+    "ann": AnnStore(config),
+    "matrix": MatrixStore(config),
 }
+stores["results"] = ResultCache(config, stores["postgres"])
 
 app = flask.Flask(__name__, template_folder="templates")
 app.secret_key = os.urandom(24)
 
-mod = hub.load("./data/universal-sentence-encoder_4")
+# TensorFlow is imported and the model loaded in the background; routes that
+# do not encode anything are served right away
+model = BackgroundModel(
+    lambda: load_model(
+        intra_op_threads=config.get("TF_INTRA_OP_THREADS"),
+        inter_op_threads=config.get("TF_INTER_OP_THREADS"),
+        logger=app.logger,
+    ),
+    request_timeout=config.get("MODEL_REQUEST_TIMEOUT", 2.0),
+    logger=app.logger,
+)
+mod = EncoderService(
+    BucketedEncoder.from_config(model, config),
+    max_batch=config.get("ENCODER_MAX_BATCH", 256),
+    max_wait=config.get("ENCODER_MAX_WAIT", 0.005),
+    ready=model.wait,
+)
+
+encoder = CachedEncoder(mod, stores["postgres"], logger=app.logger)
+
+# Jobs get their own connection so that they do not share transactions
+# with request handlers
+jobs = JobRunner(
+    PostgresStore(config),
+    max_workers=config.get("JOB_WORKERS", 1),
+    heartbeat_interval=config.get("JOB_HEARTBEAT_INTERVAL", 10.0),
+    stale_after=config.get("JOB_STALE_AFTER", 60.0),
+    logger=app.logger,
+)
+
+# Similarity graphs of communities are built in the background only
+prewarmer = SimilarityGraphPrewarmer(
+    stores["neo4j"],
+    SingleFlight(stores["postgres"], "sim_graph"),
+    concurrency=config.get("GDS_CONCURRENCY", 2),
+    logger=app.logger,
+)
+
+register_database_endpoints(app, stores, encoder, config, jobs, prewarmer)
+register_interface_endpoints(app, stores, config, prewarmer)
+register_publication_endpoints(app, stores, encoder, config, jobs, prewarmer)
+register_job_endpoints(app, jobs)
+register_encoder_endpoints(app, model, mod, started_at)
 
-register_database_endpoints(app, stores, mod)
-register_interface_endpoints(app, stores)
-register_publication_endpoints(app, stores, mod, config)
+app.logger.info(f"App ready {time.time() - started_at:.3f}sec after start")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=config["FLASK_PORT"])
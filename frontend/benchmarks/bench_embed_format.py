@@ -0,0 +1,129 @@
+"""
+Size, read latency and ranking agreement of the embedding storage formats.
+
+Vectors are sampled from the embeds table (random unit vectors if it is
+empty) and written to temporary tables, one per format. Ranking agreement is
+the overlap of the top-k cosine neighbours with the float64 ranking.
+
+    cd frontend && python -m benchmarks.bench_embed_format --rows 100000
+"""
+import argparse
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from config import load_config
+from storage.embed_format import (
+    COLUMN_TYPES,
+    DIM,
+    FORMATS,
+    decode_embeds,
+    encode_embeds,
+)
+from storage.postgres_store import PostgresStore
+
+
+def load_vectors(store, rows, seed=0):
+    cur = store.conn.cursor()
+    cur.execute("SELECT to_regclass('embeds') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT pkey, embed FROM embeds LIMIT %s", (rows,))
+        data = cur.fetchall()
+        if data:
+            cur.close()
+            pkeys = [row[0] for row in data]
+            return pkeys, decode_embeds([row[1] for row in data], store.embed_format)
+
+    cur.close()
+    rng = np.random.default_rng(seed)
+    embeds = rng.standard_normal((rows, DIM)).astype(np.float32)
+    embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+    return [f"bench/{i:08d}" for i in range(rows)], embeds
+
+
+def topk(embeds, queries, k):
+    embeds = embeds / np.linalg.norm(embeds, axis=1, keepdims=True)
+    sims = queries @ embeds.T
+    return np.argsort(-sims, axis=1)[:, 1 : k + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--fetch", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=25)
+    args = parser.parse_args()
+
+    store = PostgresStore(load_config())
+    pkeys, embeds = load_vectors(store, args.rows)
+    rng = np.random.default_rng(1)
+
+    query_idx = rng.choice(
+        len(pkeys), size=min(args.queries, len(pkeys)), replace=False
+    )
+    queries = embeds[query_idx] / np.linalg.norm(
+        embeds[query_idx], axis=1, keepdims=True
+    )
+    reference = topk(embeds.astype(np.float64), queries, args.k)
+
+    print(
+        f"{'format':>8} {'bytes/row':>10} {'table MB':>9} "
+        f"{'fetch ms':>9} {'recall@k':>9}"
+    )
+    cur = store.conn.cursor()
+    for fmt in FORMATS:
+        # Stored like float32; see bench_nearest for the vector format
+        if fmt == "vector":
+            continue
+        table = f"bench_embeds_{fmt}"
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(
+            f"CREATE TABLE {table} (pkey TEXT PRIMARY KEY, embed {COLUMN_TYPES[fmt]})"
+        )
+        for i in range(0, len(pkeys), 10000):
+            execute_values(
+                cur,
+                f"INSERT INTO {table} VALUES %s",
+                list(
+                    zip(pkeys[i : i + 10000], encode_embeds(embeds[i : i + 10000], fmt))
+                ),
+            )
+        cur.execute(f"ANALYZE {table}")
+        store.conn.commit()
+
+        cur.execute(
+            f"SELECT pg_total_relation_size('{table}'), AVG(pg_column_size(embed)) FROM {table}"
+        )
+        table_size, row_size = cur.fetchone()
+
+        elapsed = []
+        for _ in range(args.repeat):
+            sample = [pkeys[i] for i in rng.choice(len(pkeys), size=args.fetch)]
+            time_start = time.perf_counter()
+            cur.execute(
+                f"SELECT pkey, embed FROM {table} WHERE pkey = ANY(%s)", (sample,)
+            )
+            decode_embeds([row[1] for row in cur.fetchall()], fmt)
+            elapsed.append(time.perf_counter() - time_start)
+
+        decoded = decode_embeds(encode_embeds(embeds, fmt), fmt)
+        found = topk(decoded, queries, args.k)
+        recall = np.mean(
+            [len(set(a) & set(b)) / args.k for a, b in zip(reference, found)]
+        )
+
+        print(
+            f"{fmt:>8} {float(row_size):>10.0f} {table_size / 2**20:>9.1f} "
+            f"{1000 * np.median(elapsed):>9.2f} {recall:>9.3f}"
+        )
+
+        cur.execute(f"DROP TABLE {table}")
+        store.conn.commit()
+    cur.close()
+
+
+if __name__ == "__main__":
+    main()
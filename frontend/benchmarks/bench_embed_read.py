@@ -0,0 +1,58 @@
+"""
+Latency of fetching candidate vectors from the embeds table: FLOAT8[]/REAL[]
+decoded by psycopg2 into Python floats versus retrieve_embed_matrix.
+
+    cd frontend && python -m benchmarks.bench_embed_read --fetch 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from config import load_config
+from storage.embed_format import ARRAY_ELEMENTS
+from storage.postgres_store import PostgresStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--fetch", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    store = PostgresStore(load_config())
+    cur = store.conn.cursor()
+    cur.execute("SELECT pkey FROM embeds TABLESAMPLE SYSTEM (10) LIMIT 100000")
+    population = [row[0] for row in cur.fetchall()]
+    store.conn.rollback()
+    rng = np.random.default_rng(0)
+
+    def python_lists(pkeys):
+        cur.execute("SELECT pkey, embed FROM embeds WHERE pkey = ANY(%s)", (pkeys,))
+        rows = cur.fetchall()
+        store.conn.rollback()
+        return np.asarray([row[1] for row in rows], dtype=np.float32)
+
+    def matrix(pkeys):
+        return store.retrieve_embed_matrix(pkeys)[1]
+
+    methods = [("matrix", matrix)]
+    if store.embed_format in ARRAY_ELEMENTS:
+        methods.insert(0, ("python lists", python_lists))
+
+    print(f"format: {store.embed_format}, {args.fetch} vectors per fetch")
+    for name, fetch in methods:
+        elapsed = []
+        for _ in range(args.repeat):
+            pkeys = [population[i] for i in rng.choice(len(population), args.fetch)]
+            time_start = time.perf_counter()
+            fetch(pkeys)
+            elapsed.append(time.perf_counter() - time_start)
+        print(
+            f"{name:>14}: median {1000 * np.median(elapsed):.2f}ms, "
+            f"p90 {1000 * np.percentile(elapsed, 90):.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
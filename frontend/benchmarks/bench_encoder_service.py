@@ -0,0 +1,68 @@
+"""
+Encode latency under concurrent load: every client calling the model
+directly versus submitting to the micro-batching EncoderService.
+
+    cd frontend && python -m benchmarks.bench_encoder_service --clients 16
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.bench_sharded_embed import make_titles
+from embedding.model import load_model
+from embedding.service import EncoderService
+
+
+def run(encode, clients, requests, titles_per_request):
+    titles = make_titles(clients * requests * titles_per_request)
+    latencies = [[] for _ in range(clients)]
+    barrier = threading.Barrier(clients)
+
+    def client(i):
+        barrier.wait()
+        for j in range(requests):
+            start = (i * requests + j) * titles_per_request
+            time_start = time.perf_counter()
+            encode(titles[start : start + titles_per_request])
+            latencies[i].append(time.perf_counter() - time_start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    time_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - time_start
+
+    latencies = np.concatenate(latencies)
+    return (
+        1000 * np.percentile(latencies, 50),
+        1000 * np.percentile(latencies, 99),
+        len(titles) / elapsed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--titles", type=int, default=2, help="titles per request")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait", type=float, default=0.005)
+    args = parser.parse_args()
+
+    model = load_model()
+    service = EncoderService(model, max_batch=args.max_batch, max_wait=args.max_wait)
+
+    print(f"{'mode':>8} {'p50 ms':>8} {'p99 ms':>8} {'titles/sec':>11}")
+    for name, encode in [("direct", model), ("service", service)]:
+        p50, p99, throughput = run(encode, args.clients, args.requests, args.titles)
+        print(f"{name:>8} {p50:>8.2f} {p99:>8.2f} {throughput:>11.1f}")
+
+    service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Latency of content-similarity search: vectors fetched into Flask and scored
+with NumPy (retrieve_embed_matrix + rank_by_similarity) versus pushed down
+into Postgres with pgvector (PostgresStore.nearest). Requires the embeds
+table in the vector format (/db/migrate/embed?format=vector).
+
+    cd frontend && python -m benchmarks.bench_nearest --candidates 25 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from config import load_config
+from embedding.similarity import rank_by_similarity
+from storage.ann_store import AnnStore
+from storage.postgres_store import PostgresStore
+
+
+def report(name, elapsed):
+    print(
+        f"{name:>28}: median {1000 * np.median(elapsed):.2f}ms, "
+        f"p90 {1000 * np.percentile(elapsed, 90):.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--candidates", type=int, nargs="+", default=[25, 1000])
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    config = load_config()
+    store = PostgresStore(config)
+    if store.embed_format != "vector":
+        raise SystemExit("The embeds table is not in the vector format")
+
+    cur = store.conn.cursor()
+    cur.execute("SELECT pkey FROM embeds TABLESAMPLE SYSTEM (10) LIMIT 100000")
+    population = [row[0] for row in cur.fetchall()]
+    store.conn.rollback()
+    rng = np.random.default_rng(0)
+
+    def in_python(target, pkeys):
+        _, embed_target = store.retrieve_embed_matrix([target])
+        keys, embeds = store.retrieve_embed_matrix(pkeys)
+        return rank_by_similarity(embed_target[0], keys, embeds, args.k, True)
+
+    def pushed_down(target, pkeys):
+        return store.nearest(target, args.k, within=pkeys)
+
+    print(f"{len(population)} sampled keys, k={args.k}")
+    for n in args.candidates:
+        for name, score in [("python", in_python), ("pgvector", pushed_down)]:
+            elapsed = []
+            for _ in range(args.repeat):
+                sample = rng.choice(len(population), n + 1)
+                pkeys = [population[i] for i in sample]
+                time_start = time.perf_counter()
+                score(pkeys[0], pkeys[1:])
+                elapsed.append(time.perf_counter() - time_start)
+            report(f"{n} candidates, {name}", elapsed)
+
+    # Top k over the whole table
+    ann = AnnStore(config)
+    methods = [("pgvector index", lambda target: store.nearest(target, args.k))]
+    if ann.is_ready:
+        methods.append(
+            (
+                "AnnStore",
+                lambda target: ann.search(
+                    store.retrieve_embed_matrix([target])[1][0], args.k
+                ),
+            )
+        )
+    for name, search in methods:
+        elapsed = []
+        for _ in range(args.repeat):
+            target = population[rng.integers(len(population))]
+            time_start = time.perf_counter()
+            search(target)
+            elapsed.append(time.perf_counter() - time_start)
+        report(f"all rows, {name}", elapsed)
+
+
+if __name__ == "__main__":
+    main()
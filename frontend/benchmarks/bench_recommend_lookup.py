@@ -0,0 +1,87 @@
+"""
+Latency of the graph lookups of /recommend: the former sequence of
+search_by_pkey (target), the community id, gds.graph.exists, the top k SIMILAR
+neighbours and search_by_pkey (candidates) versus one
+get_recommendation_context query. Both are read-only. Publications are sampled
+from communities whose SIMILAR relationships were written, i.e. the warm path.
+
+    cd frontend && python -m benchmarks.bench_recommend_lookup --k 25
+"""
+import argparse
+import time
+
+import numpy as np
+
+from config import load_config
+from storage.neo4j_store import Neo4jStore
+
+
+def sequential(store, pkey, k):
+    store.search_by_pkey([pkey])
+    with store.driver.session() as session:
+        cid = session.run(
+            "MATCH (p:Publication {key: $pkey}) RETURN p.community_id",
+            pkey=pkey,
+        ).single()[0]
+        session.run(
+            "CALL gds.graph.exists($graph_name) YIELD exists RETURN exists",
+            graph_name=f"sim_graph_{cid}",
+        ).single()
+        result = session.run(
+            """
+            MATCH (p1:Publication {key: $pkey, community_id: $cid})
+                  -[r:SIMILAR]->(p2:Publication {community_id: $cid})
+            RETURN p2.key AS pkey, r.score AS node_similarity
+            ORDER BY r.score DESC
+            LIMIT $k
+            """,
+            pkey=pkey,
+            cid=cid,
+            k=k,
+        )
+        candidates = [record.data() for record in result]
+    store.search_by_pkey([x["pkey"] for x in candidates])
+
+
+def combined(store, pkey, k):
+    store.get_recommendation_context(pkey, k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    store = Neo4jStore(load_config())
+    with store.driver.session() as session:
+        result = session.run(
+            """
+            MATCH (s:SimilarWritten)
+            MATCH (p:Publication {community_id: s.cid})-[:SIMILAR]->()
+            RETURN DISTINCT p.key AS pkey
+            LIMIT $samples
+            """,
+            samples=args.samples,
+        )
+        pkeys = [record["pkey"] for record in result]
+    if not pkeys:
+        raise SystemExit("No publication with SIMILAR relationships")
+
+    print(f"{len(pkeys)} publications, k={args.k}")
+    for name, lookup in [("sequential", sequential), ("combined", combined)]:
+        elapsed = []
+        for _ in range(args.repeat):
+            for pkey in pkeys:
+                time_start = time.perf_counter()
+                lookup(store, pkey, args.k)
+                elapsed.append(time.perf_counter() - time_start)
+        print(
+            f"{name:>10}: median {1000 * np.median(elapsed):.2f}ms, "
+            f"p90 {1000 * np.percentile(elapsed, 90):.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Content-similarity scoring of recommendation candidates: the former
+per-candidate cosine loop with a Python sort versus one matrix-vector
+product with argpartition top-k (embedding.similarity).
+
+    cd frontend && python -m benchmarks.bench_scoring
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from embedding.similarity import rank_by_similarity
+
+
+def loop_and_sort(target, keys, candidates, k):
+    def cosine_sim(x, y):
+        return np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y))
+
+    scored = [(key, cosine_sim(target, c)) for key, c in zip(keys, candidates)]
+    scored.sort(key=lambda x: -x[1])
+    return scored[:k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25, 1000, 100000])
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--dim", type=int, default=512)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    target = rng.standard_normal(args.dim).astype(np.float32)
+
+    print(f"{'candidates':>10} {'loop ms':>9} {'matrix ms':>10} {'speedup':>8}")
+    for n in args.sizes:
+        candidates = rng.standard_normal((n, args.dim)).astype(np.float32)
+        keys = [f"key/{i}" for i in range(n)]
+        as_lists = candidates.tolist()
+
+        expected = [key for key, _ in loop_and_sort(target, keys, as_lists, args.k)]
+        found, _ = rank_by_similarity(target, keys, candidates, args.k)
+        assert found == expected
+
+        number = max(1, 20000 // n)
+        t_loop = timeit.timeit(
+            lambda: loop_and_sort(target, keys, as_lists, args.k), number=number
+        )
+        t_matrix = timeit.timeit(
+            lambda: rank_by_similarity(target, keys, candidates, args.k), number=number
+        )
+        print(
+            f"{n:>10} {1000 * t_loop / number:>9.3f} "
+            f"{1000 * t_matrix / number:>10.3f} {t_loop / t_matrix:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
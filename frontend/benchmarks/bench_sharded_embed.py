@@ -0,0 +1,89 @@
+"""
+Encoder throughput of the sharded backfill for 1 to N worker processes.
+
+Only the encoding step is measured (no Neo4j / Postgres), on synthetic titles,
+so the numbers show how the CPU-bound part scales with the number of workers.
+
+    cd frontend && python -m benchmarks.bench_sharded_embed --max-workers 8
+"""
+import argparse
+import multiprocessing as mp
+import random
+import time
+
+from embedding.sharded import default_intra_op_threads
+
+WORDS = (
+    "learning deep neural network graph database query optimization "
+    "distributed system analysis model efficient scalable approach data "
+    "knowledge retrieval semantic embedding transformer attention index"
+).split()
+
+
+def make_titles(n, seed=0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 20))) for _ in range(n)
+    ]
+
+
+def _worker(titles, batchsize, intra, barrier, out):
+    import numpy as np
+
+    from embedding.model import load_model
+
+    mod = load_model(intra_op_threads=intra, inter_op_threads=1)
+    np.array(mod(titles[:batchsize]))  # warm-up
+
+    barrier.wait()
+    time_start = time.perf_counter()
+    for i in range(0, len(titles), batchsize):
+        np.array(mod(titles[i : i + batchsize]))
+    out.put(time.perf_counter() - time_start)
+
+
+def run(num_workers, titles, batchsize):
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(num_workers)
+    out = ctx.Queue()
+    intra = default_intra_op_threads(num_workers)
+    shard_size = -(-len(titles) // num_workers)
+
+    procs = [
+        ctx.Process(
+            target=_worker,
+            args=(titles[i : i + shard_size], batchsize, intra, barrier, out),
+        )
+        for i in range(0, len(titles), shard_size)
+    ]
+    for p in procs:
+        p.start()
+    elapsed = max(out.get() for _ in procs)
+    for p in procs:
+        p.join()
+
+    return intra, len(titles) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--max-workers", type=int, default=mp.cpu_count())
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--batchsize", type=int, default=1000)
+    args = parser.parse_args()
+
+    titles = make_titles(args.rows)
+    baseline = None
+
+    print(f"{'workers':>8} {'intra':>6} {'rows/sec':>10} {'speedup':>8}")
+    for num_workers in range(1, args.max_workers + 1):
+        intra, throughput = run(num_workers, titles, args.batchsize)
+        baseline = baseline or throughput
+        print(
+            f"{num_workers:>8} {intra:>6} {throughput:>10.1f} "
+            f"{throughput / baseline:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import time
+
+import numpy as np
+
+
+def num_tokens(text):
+    return len(text.split())
+
+
+class BucketedEncoder:
+    """
+    Batching layer in front of the sentence encoder.
+
+    Inputs are sorted by token count and cut into batches whose padded size
+    (``len(batch) * longest input``) stays under a token budget, so short
+    titles are not padded to the length of the longest title of a fixed-size
+    slice. The budget adapts towards ``target_latency`` seconds per encoder
+    call, bounded by ``max_tokens`` to cap memory. Outputs are returned in the
+    original input order as a float32 array.
+    """
+
+    def __init__(
+        self,
+        mod,
+        max_tokens=200000,
+        min_tokens=2000,
+        max_batch=4096,
+        target_latency=0.5,
+    ):
+        self.mod = mod
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.max_batch = max_batch
+        self.target_latency = target_latency
+        self.token_budget = max_tokens // 4
+
+    @classmethod
+    def from_config(cls, mod, config):
+        return cls(
+            mod,
+            max_tokens=config.get("EMBED_MAX_TOKENS", 200000),
+            max_batch=config.get("EMBED_MAX_BATCH", 4096),
+            target_latency=config.get("EMBED_TARGET_LATENCY", 0.5),
+        )
+
+    def _batches(self, order, lengths):
+        start = 0
+        while start < len(order):
+            end = start
+            # order is sorted by length, so the last item is the longest
+            while (
+                end < len(order)
+                and end - start < self.max_batch
+                and (end - start + 1) * max(1, lengths[order[end]]) <= self.token_budget
+            ):
+                end += 1
+            end = max(end, start + 1)
+            yield order[start:end]
+            start = end
+
+    def _adapt(self, elapsed):
+        if not self.target_latency or elapsed <= 0:
+            return
+        scale = min(2.0, max(0.5, self.target_latency / elapsed))
+        self.token_budget = int(
+            min(self.max_tokens, max(self.min_tokens, self.token_budget * scale))
+        )
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        lengths = np.array([num_tokens(t) for t in texts])
+        order = np.argsort(lengths, kind="stable")
+
+        out = None
+        for idx in self._batches(order, lengths):
+            time_start = time.perf_counter()
+            embeds = np.asarray(self.mod([texts[i] for i in idx]), dtype=np.float32)
+            self._adapt(time.perf_counter() - time_start)
+
+            if out is None:
+                out = np.empty((len(texts), embeds.shape[1]), dtype=np.float32)
+            out[idx] = embeds
+
+        return out
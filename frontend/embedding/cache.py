@@ -0,0 +1,59 @@
+import hashlib
+
+import numpy as np
+
+
+def normalize_title(title):
+    # DBLP titles differ mostly in whitespace and the trailing period
+    return " ".join(title.split()).rstrip(".")
+
+
+def title_hash(normalized_title):
+    return hashlib.sha1(normalized_title.encode("UTF-8")).hexdigest()
+
+
+class CachedEncoder:
+    """
+    Sentence encoder with a content-addressed cache of title embeddings.
+
+    Titles are normalized and hashed; only unique titles whose hash is not in
+    the ``title_embeds`` table are passed to ``mod``. The resulting vectors
+    are stored in the cache and fanned out to every input with the same
+    normalized title. Returns a float32 array of shape (len(titles), dim).
+    """
+
+    def __init__(self, mod, store_postgres, logger=None):
+        self.mod = mod
+        self.store_postgres = store_postgres
+        self.logger = logger
+        self.last_stats = None
+
+    def __call__(self, titles):
+        normalized = [normalize_title(t) for t in titles]
+        hashes = [title_hash(t) for t in normalized]
+
+        unique = {}
+        for h, t in zip(hashes, normalized):
+            unique.setdefault(h, t)
+
+        cached = dict(zip(*self.store_postgres.retrieve_title_embeds(list(unique))))
+
+        unseen = [h for h in unique if h not in cached]
+        if unseen:
+            embeds = np.asarray(self.mod([unique[h] for h in unseen]), dtype=np.float32)
+            self.store_postgres.insert_title_embeds(unseen, embeds)
+            cached.update(zip(unseen, embeds))
+
+        self.last_stats = {
+            "titles": len(titles),
+            "unique": len(unique),
+            "cache_hits": len(unique) - len(unseen),
+            "encoded": len(unseen),
+            "hit_rate": 1 - len(unseen) / len(titles) if titles else 0.0,
+        }
+        if self.logger:
+            self.logger.info(f"Title embedding cache: {self.last_stats}")
+
+        if not titles:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([cached[h] for h in hashes])
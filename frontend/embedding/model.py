@@ -0,0 +1,186 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+MODEL_PATH = "./data/universal-sentence-encoder_4"
+
+
+class LatencyStats:
+    """Bounded record of recent encoder calls (batch size, seconds)."""
+
+    def __init__(self, maxlen=1000):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def record(self, rows, elapsed):
+        with self.lock:
+            self.calls += 1
+            self.rows += rows
+            self.total += elapsed
+            self.recent.append((rows, elapsed))
+
+    def to_dict(self):
+        with self.lock:
+            recent = np.array([e for _, e in self.recent])
+            recent_rows = sum(r for r, _ in self.recent)
+
+        ret = {
+            "calls": self.calls,
+            "rows": self.rows,
+            "total_sec": round(self.total, 3),
+        }
+        if len(recent):
+            ret.update(
+                {
+                    "recent_calls": len(recent),
+                    "p50_ms": round(1000 * float(np.percentile(recent, 50)), 2),
+                    "p99_ms": round(1000 * float(np.percentile(recent, 99)), 2),
+                    "max_ms": round(1000 * float(recent.max()), 2),
+                    "rows_per_sec": round(recent_rows / float(recent.sum()), 1),
+                }
+            )
+        return ret
+
+
+class SentenceEncoder:
+    """
+    Universal Sentence Encoder behind a ``tf.function`` with a fixed input
+    signature (a 1-D string tensor of any length), so batches of different
+    sizes reuse one traced graph. The graph is traced and warmed up when the
+    encoder is created, and every call is recorded in ``latency``.
+
+    Thread pool sizes must be set before TensorFlow runs its first op, so
+    create at most one encoder per process.
+    """
+
+    def __init__(
+        self,
+        path=MODEL_PATH,
+        intra_op_threads=None,
+        inter_op_threads=None,
+        warmup=True,
+        logger=None,
+    ):
+        import tensorflow as tf
+        import tensorflow_hub as hub
+
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+        self.tf = tf
+        self.logger = logger
+        self.model = hub.load(path)
+        self._encode = tf.function(
+            lambda texts: self.model(texts),
+            input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string)],
+        )
+        self.latency = LatencyStats()
+        self.warmup_sec = None
+
+        if warmup:
+            self.warmup()
+
+    def warmup(self, batch_sizes=(1, 64, 1024)):
+        time_start = time.perf_counter()
+        for n in batch_sizes:
+            self._encode(self.tf.constant(["warm up the sentence encoder"] * n))
+        self.warmup_sec = time.perf_counter() - time_start
+
+        if self.logger:
+            self.logger.info(f"Sentence encoder warmed up in {self.warmup_sec:.3f}sec")
+
+    def __call__(self, texts):
+        texts = list(texts)
+        time_start = time.perf_counter()
+        embeds = self._encode(self.tf.constant(texts, dtype=self.tf.string)).numpy()
+        elapsed = time.perf_counter() - time_start
+
+        self.latency.record(len(texts), elapsed)
+        if self.logger:
+            self.logger.debug(f"Encoded {len(texts)} texts in {elapsed * 1000:.1f}ms")
+        return embeds
+
+    def stats(self):
+        return {"warmup_sec": self.warmup_sec, "latency": self.latency.to_dict()}
+
+
+def load_model(path=MODEL_PATH, intra_op_threads=None, inter_op_threads=None, **kwargs):
+    return SentenceEncoder(
+        path,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        **kwargs,
+    )
+
+
+class ModelNotReady(Exception):
+    pass
+
+
+class BackgroundModel:
+    """
+    Loads the sentence encoder on a background thread so that the app can
+    serve requests while TensorFlow starts. Calls made inside a Flask request
+    wait at most ``request_timeout`` seconds and then raise ModelNotReady
+    (answered with 503); calls from jobs and other threads wait until the
+    model is loaded.
+    """
+
+    def __init__(self, loader, request_timeout=2.0, logger=None):
+        self.loader = loader
+        self.request_timeout = request_timeout
+        self.logger = logger
+        self.load_sec = None
+        self.future = concurrent.futures.Future()
+
+        threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+
+    def _load(self):
+        time_start = time.perf_counter()
+        try:
+            model = self.loader()
+        except BaseException as e:
+            self.future.set_exception(e)
+            if self.logger:
+                self.logger.error(f"Failed to load the sentence encoder: {e}")
+            return
+
+        self.load_sec = time.perf_counter() - time_start
+        self.future.set_result(model)
+        if self.logger:
+            self.logger.info(f"Sentence encoder ready in {self.load_sec:.3f}sec")
+
+    @property
+    def ready(self):
+        return self.future.done() and self.future.exception() is None
+
+    def get(self, timeout=None):
+        try:
+            return self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise ModelNotReady("The sentence encoder is still loading")
+
+    def wait(self):
+        import flask
+
+        timeout = self.request_timeout if flask.has_request_context() else None
+        return self.get(timeout)
+
+    def __call__(self, texts):
+        return self.wait()(texts)
+
+    def stats(self):
+        ret = {"ready": self.ready, "load_sec": self.load_sec}
+        if self.future.done() and self.future.exception() is not None:
+            ret["error"] = repr(self.future.exception())
+        elif self.ready:
+            ret.update(self.future.result().stats())
+        return ret
@@ -0,0 +1,233 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StageStats:
+    __slots__ = ("name", "rows", "batches", "busy", "waiting")
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def to_dict(self, elapsed):
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "busy_sec": round(self.busy, 3),
+            "wait_sec": round(self.waiting, 3),
+            "rows_per_sec": round(self.rows / self.busy, 1) if self.busy else None,
+            "utilization": round(self.busy / elapsed, 3) if elapsed else None,
+        }
+
+
+class QueueStats:
+    __slots__ = ("name", "maxsize", "samples", "total", "peak")
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total = 0
+        self.peak = 0
+
+    def sample(self, q):
+        depth = q.qsize()
+        self.samples += 1
+        self.total += depth
+        self.peak = max(self.peak, depth)
+
+    def to_dict(self):
+        return {
+            "maxsize": self.maxsize,
+            "mean_depth": round(self.total / self.samples, 2) if self.samples else 0,
+            "peak_depth": self.peak,
+        }
+
+
+def missing_only(batches, store_postgres):
+    """Anti-joins each batch of Neo4j records against the embeds table."""
+    for batch in batches:
+        missing = set(store_postgres.filter_missing_pkeys([x["pkey"] for x in batch]))
+        batch = [x for x in batch if x["pkey"] in missing]
+        if batch:
+            yield batch
+
+
+class BackfillPipeline:
+    """
+    Runs fetch, encode and write stages of the embedding backfill concurrently.
+
+    A reader thread pulls batches of ``{"pkey", "title"}`` records from
+    ``batches`` and a writer thread stores ``(pkeys, embeds)`` with ``write``,
+    while the calling thread runs ``encode`` in between. The stages are
+    connected by bounded queues, so a slow stage throttles the others instead
+    of buffering the whole corpus in memory. ``progress``, if given, is called
+    from the writer with the number of rows written so far; an exception
+    raised by it (e.g. JobCancelled) stops the pipeline and is re-raised.
+    """
+
+    def __init__(
+        self,
+        batches,
+        encode,
+        write,
+        queue_size=4,
+        logger=None,
+        log_every=10,
+        progress=None,
+    ):
+        self.batches = batches
+        self.encode = encode
+        self.write = write
+        self.progress = progress
+        self.logger = logger
+        self.log_every = log_every
+
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.encoded = queue.Queue(maxsize=queue_size)
+
+        self.stages = {name: StageStats(name) for name in ("fetch", "encode", "write")}
+        self.queues = {
+            "fetched": QueueStats("fetched", queue_size),
+            "encoded": QueueStats("encoded", queue_size),
+        }
+
+        self._stop = threading.Event()
+        self._errors = []
+        self._time_start = None
+
+    def _put(self, q, item):
+        # Poll so that a failure in another stage does not leave us blocked
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, e):
+        self._errors.append(e)
+        self._stop.set()
+
+    def _read(self):
+        stats = self.stages["fetch"]
+        try:
+            it = iter(self.batches)
+            while not self._stop.is_set():
+                t0 = time.perf_counter()
+                batch = next(it, _DONE)
+                stats.busy += time.perf_counter() - t0
+                if batch is _DONE:
+                    break
+
+                stats.rows += len(batch)
+                stats.batches += 1
+
+                t0 = time.perf_counter()
+                self.queues["fetched"].sample(self.fetched)
+                ok = self._put(self.fetched, batch)
+                stats.waiting += time.perf_counter() - t0
+                if not ok:
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self.fetched, _DONE)
+
+    def _write(self):
+        stats = self.stages["write"]
+        try:
+            while True:
+                t0 = time.perf_counter()
+                item = self._get(self.encoded)
+                stats.waiting += time.perf_counter() - t0
+                if item is _DONE:
+                    return
+
+                pkeys, embeds = item
+                t0 = time.perf_counter()
+                self.write(pkeys, embeds)
+                stats.busy += time.perf_counter() - t0
+                stats.rows += len(pkeys)
+                stats.batches += 1
+
+                if self.progress:
+                    self.progress(stats.rows)
+        except Exception as e:
+            self._fail(e)
+
+    def _encode_loop(self):
+        stats = self.stages["encode"]
+        try:
+            while True:
+                t0 = time.perf_counter()
+                self.queues["fetched"].sample(self.fetched)
+                batch = self._get(self.fetched)
+                stats.waiting += time.perf_counter() - t0
+                if batch is _DONE:
+                    break
+
+                pkeys = [x["pkey"] for x in batch]
+                titles = [x["title"] for x in batch]
+
+                t0 = time.perf_counter()
+                embeds = self.encode(titles)
+                stats.busy += time.perf_counter() - t0
+                stats.rows += len(pkeys)
+                stats.batches += 1
+
+                self.queues["encoded"].sample(self.encoded)
+                if not self._put(self.encoded, (pkeys, embeds)):
+                    break
+
+                if self.logger and stats.batches % self.log_every == 0:
+                    self.logger.info(f"Backfill progress: {self.stats()}")
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self.encoded, _DONE)
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._time_start if self._time_start else 0
+        return {
+            "elapsed_sec": round(elapsed, 3),
+            "stages": {k: v.to_dict(elapsed) for k, v in self.stages.items()},
+            "queues": {k: v.to_dict() for k, v in self.queues.items()},
+        }
+
+    def run(self):
+        self._time_start = time.perf_counter()
+
+        reader = threading.Thread(target=self._read, name="backfill-reader")
+        writer = threading.Thread(target=self._write, name="backfill-writer")
+        reader.start()
+        writer.start()
+
+        self._encode_loop()
+
+        writer.join()
+        self._stop.set()
+        reader.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        stats = self.stats()
+        if self.logger:
+            self.logger.info(f"Backfill done: {stats}")
+        return stats
@@ -0,0 +1,106 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+import numpy as np
+
+from embedding.model import LatencyStats
+
+
+class EncoderService:
+    """
+    Encoder shared by all request handlers and jobs of the process.
+
+    Submissions are queued and gathered for up to ``max_wait`` seconds or
+    ``max_batch`` texts, encoded with a single call to ``mod`` on the service
+    thread, and the rows are handed back to each caller's future. Concurrent
+    small requests thus become one batch instead of many tiny TF calls
+    competing for the same cores.
+    """
+
+    def __init__(self, mod, max_batch=256, max_wait=0.005, ready=None):
+        self.mod = mod
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # Called before queueing, e.g. to fail fast while the model loads
+        self.ready = ready
+
+        self.queue = queue.Queue()
+        self.latency = LatencyStats()
+        self.batches = LatencyStats()
+
+        self.thread = threading.Thread(
+            target=self._loop, name="encoder-service", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, texts):
+        future = concurrent.futures.Future()
+        self.queue.put((list(texts), future, time.perf_counter()))
+        return future
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.ready is not None:
+            self.ready()
+        return self.submit(texts).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _gather(self, first):
+        pending = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            pending.append(item)
+            size += len(item[0])
+
+        return pending
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            pending = self._gather(item)
+            texts = [text for texts, _, _ in pending for text in texts]
+
+            time_start = time.perf_counter()
+            try:
+                embeds = np.asarray(self.mod(texts), dtype=np.float32)
+            except Exception as e:
+                for _, future, _ in pending:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            self.batches.record(len(texts), now - time_start)
+
+            offset = 0
+            for texts, future, submitted in pending:
+                future.set_result(embeds[offset : offset + len(texts)])
+                offset += len(texts)
+                self.latency.record(len(texts), now - submitted)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests": self.latency.to_dict(),
+            "encoder_calls": self.batches.to_dict(),
+        }
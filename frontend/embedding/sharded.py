@@ -0,0 +1,241 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from embedding.batching import BucketedEncoder
+from embedding.cache import CachedEncoder
+from embedding.model import load_model
+from embedding.pipeline import BackfillPipeline, missing_only
+
+# Workers run with the Flask app directory as working directory, so that the
+# model path and the .env file resolve the same way as for the app itself.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def default_num_workers():
+    return max(1, os.cpu_count() or 1)
+
+
+def default_intra_op_threads(num_workers):
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def _report(kind, **kwargs):
+    print(json.dumps({"kind": kind, **kwargs}), flush=True)
+
+
+def embed_shard(args):
+    from config import load_config
+    from storage.neo4j_store import Neo4jStore
+    from storage.postgres_store import PostgresStore
+
+    config = load_config()
+    store_neo4j = Neo4jStore(config)
+    store_postgres = PostgresStore(config)
+    mod = BucketedEncoder.from_config(
+        load_model(
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+        ),
+        config,
+    )
+    encoder = CachedEncoder(mod, store_postgres)
+
+    batches = store_neo4j.iter_pkeys_and_titles(
+        args.batchsize, after=args.after, until=args.until
+    )
+    if args.missing_only:
+        batches = missing_only(batches, store_postgres)
+
+    def encode(titles):
+        embeds = encoder(titles)
+        _report("cache", **encoder.last_stats)
+        return embeds
+
+    def write(pkeys, embeds):
+        if not store_postgres.insert_pkeys_embeds(pkeys, embeds):
+            raise RuntimeError(f"Failed to write batch ending at {pkeys[-1]}")
+        _report("rows", n=len(pkeys))
+
+    try:
+        pipeline = BackfillPipeline(
+            batches,
+            encode=encode,
+            write=write,
+        )
+        _report("done", stats=pipeline.run())
+    finally:
+        store_neo4j.close()
+        store_postgres.close()
+
+
+def _spawn_worker(after, until, batchsize, missing_only, intra, inter):
+    args = [
+        sys.executable,
+        "-m",
+        "embedding.sharded",
+        "--after",
+        after,
+        "--batchsize",
+        str(batchsize),
+        "--intra-op-threads",
+        str(intra),
+        "--inter-op-threads",
+        str(inter),
+    ]
+    if until is not None:
+        args += ["--until", until]
+    if missing_only:
+        args += ["--missing-only"]
+
+    return subprocess.Popen(
+        args,
+        cwd=APP_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def _drain(stream, tail):
+    # Keep the pipe empty so that TF logging can never block the worker
+    for line in stream:
+        tail.append(line)
+
+
+def _pump(shard, proc, events):
+    for line in proc.stdout:
+        try:
+            events.put((shard, json.loads(line)))
+        except json.JSONDecodeError:
+            continue
+    proc.wait()
+    events.put((shard, {"kind": "exit", "code": proc.returncode}))
+
+
+def run_sharded_backfill(
+    store_neo4j,
+    num_workers=None,
+    intra_op_threads=None,
+    inter_op_threads=1,
+    batchsize=10000,
+    missing_only=False,
+    logger=None,
+    log_interval=10.0,
+    progress=None,
+):
+    """
+    Embeds all publications with title using a pool of worker processes. The
+    key space is split into disjoint ranges, one per worker, and each worker
+    loads its own encoder and opens its own Neo4j and Postgres connections.
+    Progress from all workers is merged and logged by the calling process.
+
+    ``num_workers * intra_op_threads`` should not exceed the number of cores,
+    otherwise the TF thread pools of the workers compete with each other.
+    ``progress`` is called with the total number of rows written so far; if it
+    raises, the workers are terminated and the exception is re-raised.
+    """
+    num_workers = num_workers or default_num_workers()
+    intra_op_threads = intra_op_threads or default_intra_op_threads(num_workers)
+
+    bounds = store_neo4j.get_pkey_boundaries(num_workers)
+    ranges = list(zip(bounds, bounds[1:] + [None]))
+
+    time_start = time.time()
+    events = queue.Queue()
+    procs = []
+    stderr_tails = []
+    for shard, (after, until) in enumerate(ranges):
+        proc = _spawn_worker(
+            after, until, batchsize, missing_only, intra_op_threads, inter_op_threads
+        )
+        procs.append(proc)
+        stderr_tails.append(collections.deque(maxlen=20))
+        threading.Thread(target=_pump, args=(shard, proc, events), daemon=True).start()
+        threading.Thread(
+            target=_drain, args=(proc.stderr, stderr_tails[-1]), daemon=True
+        ).start()
+
+    rows = [0] * len(procs)
+    cache = {"titles": 0, "encoded": 0}
+    stats = [None] * len(procs)
+    exit_codes = [None] * len(procs)
+    last_log = time.time()
+    try:
+        while any(code is None for code in exit_codes):
+            shard, event = events.get()
+            if event["kind"] == "rows":
+                rows[shard] += event["n"]
+                if progress:
+                    progress(sum(rows))
+            elif event["kind"] == "cache":
+                cache["titles"] += event["titles"]
+                cache["encoded"] += event["encoded"]
+            elif event["kind"] == "done":
+                stats[shard] = event["stats"]
+            elif event["kind"] == "exit":
+                exit_codes[shard] = event["code"]
+
+            if logger and time.time() - last_log > log_interval:
+                elapsed = time.time() - time_start
+                logger.info(
+                    f"Sharded backfill: {sum(rows)} rows, "
+                    f"{sum(rows) / elapsed:.1f} rows/sec, per shard {rows}"
+                )
+                last_log = time.time()
+    except BaseException:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        raise
+
+    errors = [
+        "".join(tail) if code != 0 else None
+        for tail, code in zip(stderr_tails, exit_codes)
+    ]
+
+    elapsed = time.time() - time_start
+    return {
+        "elapsed_sec": round(elapsed, 3),
+        "rows": sum(rows),
+        "rows_per_sec": round(sum(rows) / elapsed, 1) if elapsed else None,
+        "num_workers": len(procs),
+        "intra_op_threads": intra_op_threads,
+        "cache_hit_rate": (
+            round(1 - cache["encoded"] / cache["titles"], 4)
+            if cache["titles"]
+            else None
+        ),
+        "shards": [
+            {
+                "after": after,
+                "until": until,
+                "rows": rows[i],
+                "stats": stats[i],
+                "error": errors[i],
+            }
+            for i, (after, until) in enumerate(ranges)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed one key range of publications")
+    parser.add_argument("--after", default="")
+    parser.add_argument("--until", default=None)
+    parser.add_argument("--batchsize", type=int, default=10000)
+    parser.add_argument("--missing-only", action="store_true")
+    parser.add_argument("--intra-op-threads", type=int, default=None)
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    embed_shard(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
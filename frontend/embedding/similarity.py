@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def normalize(x, axis=-1):
+    """Scales vectors to unit L2 norm; zero vectors are left as they are."""
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=axis, keepdims=True)
+    norm[norm == 0] = 1.0
+    return x / norm
+
+
+def cosine_similarities(target, candidates, normalized=False):
+    """
+    Cosine similarity of one target vector with each row of a matrix. With
+    ``normalized``, vectors are taken to have unit norm already (as stored by
+    PostgresStore) and the similarity is a plain dot product.
+    """
+    candidates = np.asarray(candidates, dtype=np.float32)
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=np.float32)
+    if normalized:
+        return candidates @ np.asarray(target, dtype=np.float32)
+    return normalize(candidates) @ normalize(target)
+
+
+def top_k(scores, k):
+    """Indices of the ``k`` largest scores, in descending order of score."""
+    scores = np.asarray(scores)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def rank_by_similarity(target, keys, candidates, k, normalized=False):
+    """
+    Scores candidate vectors against the target and returns the keys and
+    cosine similarities of the top ``k``, most similar first.
+    """
+    scores = cosine_similarities(target, candidates, normalized)
+    idx = top_k(scores, k)
+    return [keys[i] for i in idx], scores[idx]
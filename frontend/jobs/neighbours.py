@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from embedding.similarity import normalize, top_k
+
+
+def compute_neighbours(store_neo4j, store_postgres, cid, pkeys, k):
+    """
+    Returns rows of (pkey, rank, cand_pkey, node_sim, content_sim) for the
+    publications ``pkeys`` of community ``cid``: like /recommend, the top k
+    SIMILAR neighbours ranked by content similarity.
+    """
+    similar = store_neo4j.get_similar_neighbours(cid, pkeys, k)
+    needed = set(similar).union(c for ns in similar.values() for c, _ in ns)
+    keys, embeds = store_postgres.retrieve_embed_matrix(list(needed))
+    index = {key: i for i, key in enumerate(keys)}
+    embeds = normalize(embeds)
+
+    rows = []
+    for pkey, neighbours in similar.items():
+        if pkey not in index:
+            continue
+        neighbours = [(c, score) for c, score in neighbours if c in index]
+        sims = embeds[[index[c] for c, _ in neighbours]] @ embeds[index[pkey]]
+        for rank, i in enumerate(top_k(sims, k)):
+            cand, node_sim = neighbours[i]
+            rows.append((pkey, rank, cand, node_sim, float(sims[i])))
+    return rows
+
+
+def refresh_community(store_neo4j, store_postgres, ensure_graph, cid, k, batchsize):
+    """Recomputes the neighbours of every publication of a community."""
+    ensure_graph(cid)
+
+    members = store_neo4j.get_community_members(cid)
+    for i in range(0, len(members), batchsize):
+        pkeys = members[i : i + batchsize]
+        rows = compute_neighbours(store_neo4j, store_postgres, cid, pkeys, k)
+        if not store_postgres.replace_neighbours(pkeys, rows):
+            raise RuntimeError(f"Failed to write neighbours of community {cid}")
+    return len(members)
+
+
+def refresh_neighbours(
+    store_neo4j,
+    store_postgres,
+    communities,
+    k,
+    ensure_graph,
+    workers=4,
+    batchsize=1000,
+    progress=None,
+):
+    """
+    Recomputes the neighbour table for ``communities``, a list of (community
+    id, size), on ``workers`` threads; ``ensure_graph(cid)`` builds the
+    similarity graph of a community if needed, and is expected to bound
+    concurrent GDS builds itself (SimilarityGraphPrewarmer.ensure shares
+    its build slots with the prewarm workers). Graph queries and scoring of
+    different communities overlap; writes share the store connection.
+    Returns the number of publications processed.
+    """
+    total = sum(size for _, size in communities)
+    done = 0
+    if progress:
+        progress(done, total)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="neighbours")
+    try:
+        futures = {
+            executor.submit(
+                refresh_community,
+                store_neo4j,
+                store_postgres,
+                ensure_graph,
+                cid,
+                k,
+                batchsize,
+            ): size
+            for cid, size in communities
+        }
+        for future in as_completed(futures):
+            future.result()
+            done += futures[future]
+            if progress:
+                progress(done, total)
+    finally:
+        # Stops at the next community if the job failed or was cancelled
+        executor.shutdown(cancel_futures=True)
+
+    return done
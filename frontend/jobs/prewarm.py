@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class SimilarityGraphPrewarmer:
+    """
+    Builds the per-community similarity graphs and SIMILAR relationships in
+    the background, so that no request has to wait for GDS.
+
+    ``schedule_all`` (called after the communities are detected) queues every
+    community. Communities that requests asked for (``request``) go first,
+    most requested first, then the others, largest first. At most
+    ``concurrency`` graphs are built at the same time, counting builds that
+    other callers (such as the neighbours job) start through ``ensure``.
+
+    Builds go through ``singleflight`` (see jobs.singleflight), which is
+    shared with other builders such as the neighbours job, so a graph is
+    never built twice at once, also across processes.
+    """
+
+    def __init__(self, store_neo4j, singleflight, concurrency=2, logger=None):
+        self.store_neo4j = store_neo4j
+        self.singleflight = singleflight
+        self.concurrency = concurrency
+        self.logger = logger
+        self.build_slots = threading.BoundedSemaphore(concurrency)
+
+        self.cond = threading.Condition()
+        self.queue = []
+        self.priority = {}
+        self.sizes = {}
+        self.requests = {}
+        self.building = set()
+        self.built = set()
+        self.failed = {}
+        self.generation = 0
+        self.counter = itertools.count()
+        self.threads = []
+        self.build_sec = 0.0
+
+    def _push(self, cid):
+        # Entries are never removed; outdated ones are skipped when popped
+        priority = (-self.requests.get(cid, 0), -self.sizes.get(cid, 0))
+        self.priority[cid] = priority
+        heapq.heappush(self.queue, (priority, next(self.counter), cid))
+        self.cond.notify()
+
+    def _start(self):
+        while len(self.threads) < self.concurrency:
+            thread = threading.Thread(
+                target=self._work,
+                name=f"prewarm-{len(self.threads)}",
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule_all(self):
+        """Queues every community, forgetting those built before."""
+        communities = self.store_neo4j.get_community_sizes()
+        with self.cond:
+            self.generation += 1
+            self.queue.clear()
+            self.priority.clear()
+            self.built.clear()
+            self.failed.clear()
+            self.sizes = dict(communities)
+            for cid, _ in communities:
+                self._push(cid)
+            self._start()
+
+        if self.logger:
+            self.logger.info(f"Prewarming {len(communities)} similarity graphs")
+
+    def request(self, cid):
+        """
+        Called by requests for a community whose graph does not exist; moves
+        it up the queue unless it was built. Returns whether it was built.
+
+        ``built`` is local to this process and outdated once another process
+        resets the graph (Louvain renumbers the communities), so it is
+        confirmed with the store.
+        """
+        with self.cond:
+            built = cid in self.built
+        if built and self.is_built(cid):
+            return True
+
+        with self.cond:
+            self.built.discard(cid)
+            self.requests[cid] = self.requests.get(cid, 0) + 1
+            if cid not in self.building:
+                self._push(cid)
+                self._start()
+            return False
+
+    def is_built(self, cid):
+        # The projection exists before the SIMILAR relationships are written
+        return self.store_neo4j.has_similar_relationships(cid)
+
+    def ensure(self, cid):
+        """
+        Builds the similarity graph of a community unless it exists, waiting
+        for a build already in progress. Returns True if this call built it.
+        """
+        return self.singleflight.run(
+            cid,
+            lambda: self._build(cid),
+            done=lambda: self.is_built(cid),
+        )
+
+    def _build(self, cid):
+        with self.build_slots:
+            self.store_neo4j.build_similarity_graph(cid)
+
+    def _next(self):
+        with self.cond:
+            while True:
+                while self.queue:
+                    priority, _, cid = heapq.heappop(self.queue)
+                    if self.priority.get(cid) != priority:
+                        continue
+                    del self.priority[cid]
+                    if cid in self.built or cid in self.building:
+                        continue
+                    self.building.add(cid)
+                    return cid, self.generation
+                self.cond.wait()
+
+    def _work(self):
+        while True:
+            cid, generation = self._next()
+            time_start = time.time()
+            try:
+                self.ensure(cid)
+                error = None
+            except Exception as e:
+                error = str(e)
+                if self.logger:
+                    self.logger.exception(f"Prewarming community {cid} failed")
+
+            with self.cond:
+                self.building.discard(cid)
+                self.build_sec += time.time() - time_start
+                # Results of a build from before the last schedule_all are void
+                if generation != self.generation:
+                    continue
+                if error is None:
+                    self.built.add(cid)
+                else:
+                    self.failed[cid] = error
+
+    def stats(self):
+        with self.cond:
+            return {
+                "communities": len(self.sizes),
+                "queued": len(self.priority),
+                "building": sorted(self.building),
+                "built": len(self.built),
+                "failed": self.failed.copy(),
+                "requested": len(self.requests),
+                "build_sec": round(self.build_sec, 3),
+                "concurrency": self.concurrency,
+                "in_flight": self.singleflight.in_flight(),
+            }
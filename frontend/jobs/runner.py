@@ -0,0 +1,215 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Handle passed to a running job function for reporting progress. Calling
+    ``progress`` or ``check_cancelled`` raises JobCancelled once cancellation
+    has been requested, so job functions stop at their next checkpoint.
+    """
+
+    def __init__(self, runner, job_id, kind, params):
+        self.runner = runner
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.done = 0
+        self.total = None
+        self._cancel = threading.Event()
+        self._last_flush = 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, done, total=None, force=False):
+        self.done = done
+        if total is not None:
+            self.total = total
+
+        now = time.time()
+        if force or now - self._last_flush >= self.runner.flush_interval:
+            self._last_flush = now
+            # Cancellation may also come from another process via the table
+            if self.runner.store.update_job(self.id, done=self.done, total=self.total):
+                self.cancel()
+
+        self.check_cancelled()
+
+
+class JobRunner:
+    """
+    Runs long admin operations on a thread pool, outside of HTTP requests.
+
+    Job state (status, progress, result) is persisted in the Postgres ``jobs``
+    table so it can be polled from any worker. Job functions are registered by
+    kind and called as ``fn(job, **params)``; their return value is stored as
+    the job result.
+
+    Each job is owned by the runner that queued it (host, pid and a random
+    token), which sends a heartbeat for its jobs every ``heartbeat_interval``
+    seconds. Jobs are failed as interrupted only once their owner is gone: a
+    process of this host that no longer exists, or no heartbeat for
+    ``stale_after`` seconds.
+    """
+
+    def __init__(
+        self,
+        store_postgres,
+        max_workers=1,
+        flush_interval=1.0,
+        heartbeat_interval=10.0,
+        stale_after=60.0,
+        logger=None,
+    ):
+        self.store = store_postgres
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.logger = logger
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.kinds = {}
+        self.internal = set()
+        self.active = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+
+        self.store.create_job_table()
+        self.fail_stale_jobs()
+        self.heartbeat = threading.Thread(
+            target=self._beat, name="job-heartbeat", daemon=True
+        )
+        self.heartbeat.start()
+
+    def _is_dead(self, owner):
+        host, pid, _ = owner.rsplit(":", 2)
+        if host != self.host or owner == self.owner:
+            return False
+        # A previous process with our pid (e.g. restarted in a container)
+        if int(pid) == os.getpid():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def fail_stale_jobs(self):
+        """Fails the queued and running jobs of runners that are gone."""
+        dead = [o for o in self.store.get_active_job_owners() if self._is_dead(o)]
+        failed = self.store.fail_stale_jobs(self.stale_after, dead_owners=dead)
+        if failed and self.logger:
+            self.logger.warning(f"Jobs {failed} were interrupted")
+        return failed
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.store.heartbeat_jobs(self.owner)
+                self.fail_stale_jobs()
+            except Exception:
+                if self.logger:
+                    self.logger.exception("Job heartbeat failed")
+
+    def register(self, kind, fn, internal=False):
+        """
+        Registers a job function. Internal jobs can only be submitted by the
+        app itself, not through POST /jobs/<kind>.
+        """
+        self.kinds[kind] = fn
+        if internal:
+            self.internal.add(kind)
+
+    def submit(self, kind, **params):
+        if kind not in self.kinds:
+            raise KeyError(kind)
+
+        job_id = self.store.insert_job(kind, params, owner=self.owner)
+        if job_id is None:
+            raise RuntimeError("Failed to create a job")
+
+        job = Job(self, job_id, kind, params)
+        self.active[job_id] = job
+        self.executor.submit(self._run, job)
+        return job_id
+
+    def _run(self, job):
+        try:
+            if not self.store.start_job(job.id):
+                if self.logger:
+                    self.logger.info(f"Job {job.id} ({job.kind}) was not started")
+                return
+
+            if self.logger:
+                self.logger.info(f"Job {job.id} ({job.kind}) started")
+            result = self.kinds[job.kind](job, **job.params)
+            self.store.update_job(job.id, done=job.done, total=job.total)
+            self.store.finish_job(job.id, "succeeded", result=result)
+        except JobCancelled:
+            self.store.finish_job(job.id, "cancelled")
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+            self.store.finish_job(job.id, "failed", error=traceback.format_exc())
+        finally:
+            self.active.pop(job.id, None)
+
+    def cancel(self, job_id):
+        job = self.active.get(job_id)
+        if job is not None:
+            job.cancel()
+        return self.store.request_job_cancel(job_id)
+
+    def get(self, job_id):
+        row = self.store.get_job(job_id)
+        if row is None:
+            return None
+
+        done, total, elapsed = row["done"], row["total"], row["elapsed"]
+        elapsed = float(elapsed) if elapsed is not None else None
+        rate = done / elapsed if elapsed else None
+
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "params": row["params"],
+            "status": row["status"],
+            "done": done,
+            "total": total,
+            "percent": round(100 * done / total, 2) if total else None,
+            "rows_per_sec": round(rate, 1) if rate else None,
+            "eta_sec": (
+                round((total - done) / rate, 1)
+                if rate and total and row["status"] == "running"
+                else None
+            ),
+            "elapsed_sec": round(elapsed, 3) if elapsed is not None else None,
+            "cancel_requested": row["cancel_requested"],
+            "created_at": row["created_at"].isoformat(),
+            "started_at": row["started_at"] and row["started_at"].isoformat(),
+            "finished_at": row["finished_at"] and row["finished_at"].isoformat(),
+            "result": row["result"],
+            "error": row["error"],
+        }
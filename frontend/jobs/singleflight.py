@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Runs at most one build per key at a time, across threads and processes.
+
+    Threads of one process asking for a key that is already being built
+    wait for that build and share its outcome. Across processes, the build
+    holds a Postgres advisory lock on the key (on a connection of its own),
+    so another process blocks until it is released and then finds the work
+    done through ``done``.
+    """
+
+    def __init__(self, store_postgres, namespace):
+        self.store_postgres = store_postgres
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(self, key, build, done=None):
+        """
+        Calls ``build()`` unless ``done()`` reports the work as already done
+        once the lock is held. Returns True if this call built it.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Future()
+
+        if not leader:
+            flight.result()
+            return False
+
+        try:
+            flight.set_result(self._run_locked(key, build, done))
+        except Exception as e:
+            flight.set_exception(e)
+        finally:
+            with self.lock:
+                del self.flights[key]
+        return flight.result()
+
+    def _run_locked(self, key, build, done):
+        conn = self.store_postgres.get_db_conn()
+        conn.autocommit = True
+        lock_key = f"{self.namespace}:{key}"
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT pg_advisory_lock(hashtextextended(%s, 0))", (lock_key,)
+                )
+                try:
+                    if done is not None and done():
+                        return False
+                    build()
+                    return True
+                finally:
+                    cur.execute(
+                        "SELECT pg_advisory_unlock(hashtextextended(%s, 0))",
+                        (lock_key,),
+                    )
+        finally:
+            conn.close()
+
+    def in_flight(self):
+        with self.lock:
+            return sorted(self.flights)
@@ -0,0 +1,333 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from embedding.similarity import normalize, top_k
+
+INDEX_FILES = ("centroids", "offsets", "vectors", "keys")
+
+
+class AnnStore:
+    """
+    In-process approximate nearest-neighbour index (IVF-flat) over the title
+    embeddings.
+
+    Vectors are clustered with spherical k-means; each cluster ("list") is a
+    contiguous block of unit vectors in ``vectors.npy``, with its keys in
+    ``keys.npy`` and block boundaries in ``offsets.npy``. A query scores the
+    centroids, scans the ``nprobe`` closest lists and returns the top k by
+    inner product (= cosine, vectors being normalized). The arrays are
+    memory-mapped, so the page cache is shared by all workers.
+
+    Each build is written to its own directory and ``current`` is switched to
+    it with an atomic symlink replace. Vectors added after the build (new
+    uploads) are kept in a small delta that is scanned exhaustively and
+    persisted next to the index (``delta.npz``, replaced atomically) until the
+    next build, which carries over what it did not index. Every process
+    notices a new index or delta on its next search and reopens it.
+    """
+
+    def __init__(self, config):
+        self.path = config.get("ANN_INDEX_PATH", "./data/ann")
+        self.nprobe = config.get("ANN_NPROBE", 32)
+        self.dtype = np.dtype(config.get("ANN_DTYPE", "float32"))
+        self.keep = config.get("ANN_INDEX_KEEP", 2)
+        self.lock = threading.Lock()
+
+        self.index = None
+        self.delta_keys = np.array([], dtype=object)
+        self.delta_vectors = None
+        self.delta_version = None
+        self.refresh()
+
+    @property
+    def current(self):
+        return os.path.join(self.path, "current")
+
+    @property
+    def is_ready(self):
+        self.refresh()
+        return self.index is not None
+
+    def refresh(self):
+        """Opens the current index and delta if changed since the last call."""
+        try:
+            target = os.readlink(self.current)
+        except OSError:
+            return False
+        directory = os.path.join(self.path, target)
+        version = _file_version(os.path.join(directory, "delta.npz"))
+
+        index = self.index
+        if index is not None and index["name"] == target:
+            if version == self.delta_version:
+                return False
+        else:
+            index = {
+                name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in INDEX_FILES
+            }
+            index["name"] = target
+            index["directory"] = directory
+
+        delta_keys, delta_vectors = self._load_delta(directory)
+        with self.lock:
+            self.index = index
+            self.delta_keys = delta_keys
+            self.delta_vectors = delta_vectors
+            self.delta_version = version
+        return True
+
+    def _load_delta(self, directory):
+        try:
+            with np.load(os.path.join(directory, "delta.npz")) as delta:
+                return delta["keys"], delta["vectors"]
+        except FileNotFoundError:
+            return np.array([], dtype=object), None
+
+    def stats(self):
+        self.refresh()
+        index = self.index
+        if index is None:
+            return {"ready": False}
+        return {
+            "ready": True,
+            "directory": index["directory"],
+            "size": len(index["keys"]),
+            "lists": len(index["centroids"]),
+            "delta_size": len(self.delta_keys),
+            "nprobe": self.nprobe,
+        }
+
+    def search(self, vector, k, nprobe=None, exclude=()):
+        """Returns the keys and similarities of the approximate top ``k``."""
+        self.refresh()
+        with self.lock:
+            index = self.index
+            delta_keys, delta_vectors = self.delta_keys, self.delta_vectors
+        if index is None:
+            return [], np.zeros(0, dtype=np.float32)
+
+        query = normalize(vector)
+        offsets = index["offsets"]
+        lists = top_k(index["centroids"] @ query, nprobe or self.nprobe)
+
+        scores = [
+            np.asarray(index["vectors"][offsets[l] : offsets[l + 1]], np.float32)
+            @ query
+            for l in lists
+        ]
+        keys = [index["keys"][offsets[l] : offsets[l + 1]] for l in lists]
+        if delta_vectors is not None:
+            keys.append(delta_keys)
+            scores.append(delta_vectors.astype(np.float32) @ query)
+
+        keys = np.concatenate(keys) if keys else np.array([])
+        scores = np.concatenate(scores) if scores else np.zeros(0, np.float32)
+
+        # A key can be in the index and the delta; exclusions are dropped too
+        found, sims = [], []
+        exclude = set(exclude)
+        for i in top_k(scores, k + len(exclude) + len(delta_keys)):
+            key = keys[i].decode("UTF-8") if isinstance(keys[i], bytes) else keys[i]
+            if key in exclude:
+                continue
+            exclude.add(key)
+            found.append(key)
+            sims.append(scores[i])
+            if len(found) == k:
+                break
+        return found, np.array(sims, dtype=np.float32)
+
+    def add(self, pkeys, embeds):
+        """Adds vectors of new publications to the delta of the index."""
+        if not self.is_ready or not len(pkeys):
+            return
+
+        embeds = normalize(embeds).astype(self.dtype)
+        keys = [key.encode("UTF-8") for key in pkeys]
+        # A build may switch the index meanwhile; its delta is carried over
+        # under the same lock, so retry on the new index if that happened
+        while not self._extend_delta(self.index["directory"], keys, embeds):
+            self.refresh()
+        self.refresh()
+
+    def _extend_delta(self, directory, keys, vectors, switched=False):
+        # Other processes may add to the same delta; reread it under a file lock
+        with open(os.path.join(directory, "delta.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not switched and os.readlink(self.current) != os.path.basename(
+                directory
+            ):
+                return False
+            delta_keys, delta_vectors = self._load_delta(directory)
+            if delta_vectors is not None:
+                keys = np.concatenate([delta_keys.astype(bytes), keys])
+                vectors = np.concatenate([delta_vectors, vectors])
+            path = os.path.join(directory, f"delta-{os.getpid()}.npz")
+            np.savez(path, keys=np.asarray(keys, dtype=bytes), vectors=vectors)
+            os.replace(path, os.path.join(directory, "delta.npz"))
+        return True
+
+    def _carry_over_delta(self, previous, directory, indexed):
+        # Vectors added to the previous index while this one was built
+        with open(os.path.join(previous, "delta.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            delta_keys, delta_vectors = self._load_delta(previous)
+        if delta_vectors is None:
+            return
+        missing = np.array(
+            [key.decode("UTF-8") not in indexed for key in delta_keys.astype(bytes)],
+            dtype=bool,
+        )
+        if missing.any():
+            self._extend_delta(
+                directory,
+                delta_keys.astype(bytes)[missing],
+                delta_vectors[missing],
+                switched=True,
+            )
+
+    def build(self, store_postgres, nlist=None, sample=100000, iters=10, progress=None):
+        """
+        Builds a new index from the embeds table and switches to it. Returns
+        the number of indexed vectors.
+        """
+        num = store_postgres.count_embeds()
+        if not num:
+            raise ValueError("No embeddings to index")
+        # Unique and ordered by start time, also for concurrent builds
+        os.makedirs(self.path, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix=f"index-{time.time_ns()}-", dir=self.path)
+
+        # Pass 1: stream all vectors to disk in key order; rows inserted
+        # since counting grow the scratch file
+        scratch = self._open_scratch(directory, num)
+        keys = []
+        for batch_keys, batch in store_postgres.iter_embed_batches():
+            if len(keys) + len(batch) > len(scratch):
+                scratch = self._open_scratch(
+                    directory, (len(keys) + len(batch)) * 5 // 4, scratch
+                )
+            scratch[len(keys) : len(keys) + len(batch)] = normalize(batch)
+            keys.extend(batch_keys)
+            if progress:
+                progress(len(keys) // 2, max(num, len(keys)))
+        num = len(keys)
+        scratch = scratch[:num]
+
+        # Train centroids on a sample and assign every vector to a list
+        nlist = nlist or int(np.clip(4 * np.sqrt(num), 1, 65536))
+        centroids = self._train(scratch[:num], nlist, sample, iters)
+        nlist = len(centroids)
+        assign = np.empty(num, dtype=np.int32)
+        for i in range(0, num, 65536):
+            chunk = np.asarray(scratch[i : i + 65536], np.float32)
+            assign[i : i + 65536] = np.argmax(chunk @ centroids.T, axis=1)
+
+        # Pass 2: write vectors grouped by list
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory, "vectors.npy"),
+            mode="w+",
+            dtype=self.dtype,
+            shape=(num, scratch.shape[1]),
+        )
+        for i in range(0, num, 65536):
+            idx = order[i : i + 65536]
+            vectors[i : i + len(idx)] = scratch[idx]
+            if progress:
+                progress(num // 2 + (i + len(idx)) // 2, num)
+        vectors.flush()
+        del vectors, scratch
+        os.remove(os.path.join(directory, "scratch.npy"))
+
+        keys = np.array(keys, dtype=object)[order]
+        max_len = max((len(k.encode("UTF-8")) for k in keys), default=1)
+        np.save(
+            os.path.join(directory, "keys.npy"),
+            np.array([k.encode("UTF-8") for k in keys], dtype=f"S{max_len}"),
+        )
+        np.save(os.path.join(directory, "centroids.npy"), centroids)
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+
+        previous = None
+        if os.path.islink(self.current):
+            previous = os.path.join(self.path, os.readlink(self.current))
+        self._switch(directory)
+        if previous:
+            self._carry_over_delta(previous, directory, set(keys))
+        self.refresh()
+        self._remove_old_indexes()
+        return num
+
+    def _open_scratch(self, directory, rows, old=None):
+        path = os.path.join(directory, "scratch.npy")
+        scratch = np.lib.format.open_memmap(
+            path + ".new" if old is not None else path,
+            mode="w+",
+            dtype=self.dtype,
+            shape=(rows, 512),
+        )
+        if old is not None:
+            for i in range(0, len(old), 65536):
+                scratch[i : min(i + 65536, len(old))] = old[i : i + 65536]
+            del old
+            os.replace(path + ".new", path)
+        return scratch
+
+    def _train(self, vectors, nlist, sample, iters):
+        rng = np.random.default_rng(0)
+        sample = np.asarray(
+            vectors[
+                np.sort(rng.choice(len(vectors), min(sample, len(vectors)), False))
+            ],
+            np.float32,
+        )
+        nlist = min(nlist, len(sample))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+        for _ in range(iters):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = normalize(sums)
+
+        return centroids
+
+    def _switch(self, directory):
+        link = os.path.join(self.path, f"current-{os.getpid()}")
+        os.symlink(os.path.basename(directory), link)
+        os.replace(link, self.current)
+
+    def _remove_old_indexes(self):
+        # Like MatrixStore snapshots: processes that still map a removed
+        # index keep reading it until they refresh. Only indexes older than
+        # the current one are removed, so a later build still running keeps
+        # its directory.
+        current = os.readlink(self.current)
+        names = sorted(
+            name
+            for name in os.listdir(self.path)
+            if name.startswith("index-") and name < current
+        )
+        for name in names[: max(len(names) - self.keep + 1, 0)]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,136 @@
+"""
+Storage formats of sentence embeddings in Postgres.
+
+  - float64: FLOAT8[] (8 bytes per dimension, the original format)
+  - float32: REAL[] (4 bytes per dimension)
+  - float16: BYTEA of packed little-endian float16 (2 bytes per dimension)
+  - int8: BYTEA of a float32 scale followed by int8 values, i.e. scalar
+    quantization with a per-vector scale (1 byte per dimension)
+  - vector: pgvector vector(512) (4 bytes per dimension), which lets
+    PostgresStore.nearest run similarity search in the database
+
+Vectors are always decoded to float32 NumPy arrays. Reads that select the
+column through ``packed_column`` get BYTEA for every format (array columns
+via ``array_send``), which ``decode_packed`` turns into a matrix with
+``np.frombuffer`` without creating a Python object per element.
+"""
+import struct
+
+import numpy as np
+
+DIM = 512
+
+COLUMN_TYPES = {
+    "float64": f"FLOAT8[{DIM}]",
+    "float32": f"REAL[{DIM}]",
+    "float16": "BYTEA",
+    "int8": "BYTEA",
+    "vector": f"vector({DIM})",
+}
+
+FORMATS = tuple(COLUMN_TYPES)
+
+# Big-endian element types of the binary array format of array columns
+ARRAY_ELEMENTS = {
+    "float64": np.dtype(">f8"),
+    "float32": np.dtype(">f4"),
+}
+
+# ndim, flags, element oid, dimension size, lower bound
+ARRAY_HEADER_SIZE = 20
+
+# dimension, unused (binary format of pgvector's vector type)
+VECTOR_HEADER_SIZE = 4
+
+
+def check_format(fmt):
+    if fmt not in COLUMN_TYPES:
+        raise ValueError(f"Unknown embedding format {fmt}, expected one of {FORMATS}")
+    return fmt
+
+
+def encode_embeds(embeds, fmt):
+    """Converts an (n, dim) array into a list of values for the embed column."""
+    embeds = np.asarray(embeds)
+    if embeds.ndim == 1:
+        embeds = embeds[np.newaxis, :]
+
+    if fmt == "float64":
+        return embeds.astype(np.float64).tolist()
+    if fmt == "float32":
+        return embeds.astype(np.float32).tolist()
+    if fmt == "float16":
+        return [row.tobytes() for row in embeds.astype("<f2")]
+    if fmt == "int8":
+        embeds = embeds.astype(np.float32)
+        scale = np.abs(embeds).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        quant = np.clip(np.rint(embeds / scale[:, np.newaxis]), -127, 127)
+        quant = quant.astype(np.int8)
+        return [s.tobytes() + q.tobytes() for s, q in zip(scale.astype("<f4"), quant)]
+    if fmt == "vector":
+        header = struct.pack(">hh", embeds.shape[1], 0)
+        return [header + row.tobytes() for row in embeds.astype(">f4")]
+    raise ValueError(f"Unknown embedding format {fmt}")
+
+
+def decode_embeds(values, fmt):
+    """Converts values of the embed column into an (n, dim) float32 array."""
+    values = list(values)
+    if not values:
+        return np.zeros((0, DIM), dtype=np.float32)
+
+    if fmt in ("float64", "float32"):
+        return np.asarray(values, dtype=np.float32)
+    if fmt == "float16":
+        buf = b"".join(values)
+        return (
+            np.frombuffer(buf, dtype="<f2").reshape(len(values), -1).astype(np.float32)
+        )
+    if fmt == "int8":
+        buf = np.frombuffer(b"".join(values), dtype=np.uint8).reshape(len(values), -1)
+        scale = buf[:, :4].copy().view("<f4")
+        quant = buf[:, 4:].view(np.int8)
+        return quant.astype(np.float32) * scale
+    if fmt == "vector":
+        buf = np.frombuffer(b"".join(values), dtype=np.uint8).reshape(len(values), -1)
+        return buf[:, VECTOR_HEADER_SIZE:].copy().view(">f4").astype(np.float32)
+    raise ValueError(f"Unknown embedding format {fmt}")
+
+
+def packed_column(fmt, column="embed"):
+    """SQL expression selecting ``column`` as BYTEA for ``decode_packed``."""
+    if fmt in ARRAY_ELEMENTS:
+        return f"array_send({column})"
+    if fmt == "vector":
+        return f"vector_send({column})"
+    return column
+
+
+def decode_packed(values, fmt):
+    """Converts values selected with ``packed_column`` into a float32 matrix."""
+    values = list(values)
+    if not values:
+        return np.zeros((0, DIM), dtype=np.float32)
+
+    if fmt not in ARRAY_ELEMENTS:
+        return decode_embeds(values, fmt)
+
+    buf = b"".join(values)
+    dim = (len(buf) // len(values) - ARRAY_HEADER_SIZE) // (
+        4 + ARRAY_ELEMENTS[fmt].itemsize
+    )
+    row = np.dtype(
+        [
+            ("header", f"V{ARRAY_HEADER_SIZE}"),
+            ("items", [("len", ">i4"), ("val", ARRAY_ELEMENTS[fmt])], (dim,)),
+        ]
+    )
+    return np.frombuffer(buf, dtype=row)["items"]["val"].astype(np.float32)
+
+
+def vector_literal(vector):
+    """Text representation of a vector for a pgvector ``vector`` parameter."""
+    return (
+        "[" + ",".join(map(repr, np.asarray(vector, dtype=np.float32).tolist())) + "]"
+    )
@@ -0,0 +1,157 @@
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from embedding.similarity import normalize
+
+
+class MatrixStore:
+    """
+    Read-only snapshot of the embeds table for serving: one contiguous
+    ``vectors.npy`` matrix (float32 or float16, unit normalized) and a sorted
+    ``keys.npy`` array whose positions are the matrix rows. Both are opened
+    with ``mmap_mode="r"``, so lookups are binary searches and page cache
+    reads shared by every process serving the app, without a round trip to
+    Postgres.
+
+    ``export`` writes a new snapshot directory and switches ``current`` to it
+    with an atomic symlink replace; readers notice the switch on their next
+    lookup and reopen the files.
+    """
+
+    def __init__(self, config):
+        self.path = config.get("EMBED_MATRIX_PATH", "./data/embeds")
+        self.dtype = np.dtype(config.get("EMBED_MATRIX_DTYPE", "float32"))
+        self.keep = config.get("EMBED_MATRIX_KEEP", 2)
+        self.lock = threading.Lock()
+
+        self.snapshot = None
+        self.refresh()
+
+    @property
+    def current(self):
+        return os.path.join(self.path, "current")
+
+    @property
+    def is_ready(self):
+        self.refresh()
+        return self.snapshot is not None
+
+    def refresh(self):
+        """Opens the current snapshot if it changed since the last call."""
+        try:
+            name = os.readlink(self.current)
+        except OSError:
+            return False
+        if self.snapshot is not None and self.snapshot["name"] == name:
+            return False
+
+        directory = os.path.join(self.path, name)
+        snapshot = {
+            "name": name,
+            "keys": np.load(os.path.join(directory, "keys.npy"), mmap_mode="r"),
+            "vectors": np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r"),
+        }
+        with self.lock:
+            self.snapshot = snapshot
+        return True
+
+    def stats(self):
+        if not self.is_ready:
+            return {"ready": False}
+        snapshot = self.snapshot
+        return {
+            "ready": True,
+            "snapshot": snapshot["name"],
+            "rows": len(snapshot["keys"]),
+            "dtype": str(snapshot["vectors"].dtype),
+        }
+
+    def retrieve_embed_matrix(self, pkeys):
+        """
+        Returns the keys found in the snapshot (as an object array, in key
+        order) and their vectors as a float32 matrix, like
+        PostgresStore.retrieve_embed_matrix.
+        """
+        self.refresh()
+        snapshot = self.snapshot
+        if snapshot is None or not len(pkeys):
+            return np.array([], dtype=object), np.zeros((0, 512), dtype=np.float32)
+
+        keys = snapshot["keys"]
+        # Longer keys would be truncated to (and could match) another key
+        query = [
+            key
+            for key in (pkey.encode("UTF-8") for pkey in pkeys)
+            if len(key) <= keys.dtype.itemsize
+        ]
+        query = np.unique(np.array(query, dtype=keys.dtype))
+
+        rows = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        rows = rows[keys[rows] == query]
+        found = np.array([key.decode("UTF-8") for key in keys[rows]], dtype=object)
+        return found, np.asarray(snapshot["vectors"][rows], dtype=np.float32)
+
+    def export(self, store_postgres, progress=None):
+        """
+        Writes a snapshot of the embeds table and switches to it. Returns the
+        number of rows.
+        """
+        num = store_postgres.count_embeds()
+        if not num:
+            raise ValueError("No embeddings to export")
+        name = f"snapshot-{int(time.time() * 1000)}"
+        directory = os.path.join(self.path, name)
+        os.makedirs(directory)
+
+        # Rows come ordered by the database collation, which need not be the
+        # byte order searched by retrieve_embed_matrix; reorder afterwards
+        scratch = np.lib.format.open_memmap(
+            os.path.join(directory, "scratch.npy"),
+            mode="w+",
+            dtype=self.dtype,
+            shape=(num, 512),
+        )
+        keys = []
+        for batch_keys, batch in store_postgres.iter_embed_batches():
+            batch = batch[: num - len(keys)]
+            scratch[len(keys) : len(keys) + len(batch)] = normalize(batch)
+            keys.extend(key.encode("UTF-8") for key in batch_keys[: len(batch)])
+            if progress:
+                progress(len(keys), num)
+        num = len(keys)
+
+        keys = np.array(keys, dtype=f"S{max(map(len, keys), default=1)}")
+        order = np.argsort(keys, kind="stable")
+        np.save(os.path.join(directory, "keys.npy"), keys[order])
+
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory, "vectors.npy"),
+            mode="w+",
+            dtype=self.dtype,
+            shape=(num, 512),
+        )
+        for i in range(0, num, 65536):
+            vectors[i : i + 65536] = scratch[order[i : i + 65536]]
+        vectors.flush()
+        del vectors, scratch
+        os.remove(os.path.join(directory, "scratch.npy"))
+
+        link = os.path.join(self.path, f"current-{os.getpid()}")
+        os.symlink(name, link)
+        os.replace(link, self.current)
+        self.refresh()
+        self._remove_old_snapshots()
+        return num
+
+    def _remove_old_snapshots(self):
+        # Processes that still map a removed snapshot keep reading it until
+        # they refresh, as the files stay allocated while mapped
+        names = sorted(
+            name for name in os.listdir(self.path) if name.startswith("snapshot-")
+        )
+        for name in names[: -self.keep]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -1,3 +1,6 @@
+import threading
+import time
+
 from neo4j import GraphDatabase
 
 
@@ -10,6 +13,15 @@ class Neo4jStore:
             auth=(config["NEO4J_USER"], config["NEO4J_PASS"]),
         )
 
+        # Similarity graph projections are evicted, least recently used
+        # first, to keep the GDS catalog within this many bytes
+        self.gds_memory_budget = config.get("GDS_MEMORY_BUDGET", 2 * 1024**3)
+        self.projection_lock = threading.Lock()
+        self.projection_last_used = {}
+        self.projections_building = set()
+        self.projection_evictions = 0
+        self.projection_evicted_bytes = 0
+
     def close(self):
         self.driver.close()
 
@@ -36,6 +48,20 @@ class Neo4jStore:
                 """
             )
 
+            _ = session.run(
+                """
+                CREATE INDEX PublicationCommunityIndex IF NOT EXISTS
+                FOR (p:Publication) ON (p.community_id)
+                """
+            )
+
+            _ = session.run(
+                """
+                CREATE INDEX SimilarWrittenIndex IF NOT EXISTS
+                FOR (s:SimilarWritten) ON (s.cid)
+                """
+            )
+
             _ = session.run(
                 """
                 CREATE FULLTEXT INDEX PublicationFulltextIndex IF NOT EXISTS 
@@ -65,22 +91,74 @@ class Neo4jStore:
             result = session.run("MATCH (s:Stream) RETURN COUNT(s)")
             return result.single()[0]
 
-    def get_pkeys_and_titles_of(self, start, end):
+    def get_pkeys_and_titles_after(self, after, num, until=None):
         with self.driver.session() as session:
             result = session.run(
                 """
                 MATCH (p:Publication)
-                WHERE p.title <> ''
+                WHERE p.key > $after
+                    AND ($until IS NULL OR p.key <= $until)
+                    AND p.title <> ''
                 RETURN p.key AS pkey, p.title as title
-                ORDER BY pkey
-                SKIP $start
+                ORDER BY p.key
                 LIMIT $num
                 """,
-                start=start,
-                num=end - start,
+                after=after,
+                until=until,
+                num=num,
             )
             return [record.data() for record in result]
 
+    def iter_pkeys_and_titles(self, batchsize, after="", until=None):
+        """
+        Yields batches of publications with title ordered by key, optionally
+        bounded to keys in (after, until]. Each batch resumes right after the
+        last key of the previous one, so that every query is a seek on the key
+        index (PublicationIndex, created by the parser) instead of a SKIP over
+        all preceding rows.
+        """
+        while True:
+            batch = self.get_pkeys_and_titles_after(after, batchsize, until)
+            if not batch:
+                return
+
+            yield batch
+
+            if len(batch) < batchsize:
+                return
+            after = batch[-1]["pkey"]
+
+    def get_pkey_boundaries(self, num_shards):
+        """
+        Splits the publications with title into ``num_shards`` key ranges of
+        about the same size. Returns the exclusive lower bounds; the last shard
+        is unbounded above.
+        """
+        num_publ = self.get_num_publications_with_title()
+        step = max(1, -(-num_publ // num_shards))
+
+        bounds = [""]
+        with self.driver.session() as session:
+            while len(bounds) < num_shards:
+                result = session.run(
+                    """
+                    MATCH (p:Publication)
+                    WHERE p.key > $after AND p.title <> ''
+                    RETURN p.key AS pkey
+                    ORDER BY p.key
+                    SKIP $skip
+                    LIMIT 1
+                    """,
+                    after=bounds[-1],
+                    skip=step - 1,
+                )
+                record = result.single()
+                if record is None:
+                    break
+                bounds.append(record["pkey"])
+
+        return bounds
+
     def get_titles(self, pkeys):
         with self.driver.session() as session:
             result = session.run(
@@ -109,6 +187,57 @@ class Neo4jStore:
             )
             return [record.data() for record in result]
 
+    def get_recommendation_context(self, pkey, k):
+        """
+        Returns everything /recommend needs from the graph in one query: the
+        target publication with its authors, its community id, whether the
+        SIMILAR relationships of the community were written, and the top k
+        SIMILAR neighbours (most similar first) with their authors, each
+        author list in authorship order. Returns None if the publication does
+        not exist.
+
+        Candidates are only complete if ``similar_written``; otherwise the
+        similarity graph of the community is not built yet or still being
+        written, and only the prewarmer (see jobs.prewarm) builds it.
+        """
+        with self.driver.session() as session:
+            result = session.run(
+                """
+                MATCH (p:Publication {key: $pkey})
+                OPTIONAL MATCH (p)-[ra:AUTHORED_BY]->(a:Author)
+                WITH p, a ORDER BY ra.order
+                WITH p, COLLECT(a) AS authors
+                OPTIONAL MATCH (s:SimilarWritten {cid: p.community_id})
+                WITH p, authors, s IS NOT NULL AS similar_written
+                CALL gds.graph.exists('sim_graph_' + toString(p.community_id))
+                YIELD exists
+                CALL {
+                    WITH p
+                    MATCH (p)-[r:SIMILAR]->(c:Publication)
+                    WHERE c.community_id = p.community_id
+                    WITH c, r.score AS score ORDER BY score DESC LIMIT $k
+                    OPTIONAL MATCH (c)-[rc:AUTHORED_BY]->(ca:Author)
+                    WITH c, score, ca ORDER BY score DESC, rc.order
+                    WITH c, score, COLLECT(ca) AS authors
+                    ORDER BY score DESC
+                    RETURN COLLECT(
+                        {p: c, authors: authors, node_similarity: score}
+                    ) AS candidates
+                }
+                RETURN p, authors, p.community_id AS community_id,
+                       exists AS graph_exists, similar_written, candidates
+                """,
+                pkey=pkey,
+                k=k,
+            )
+            record = result.single()
+            if not record:
+                return None
+
+        if record["graph_exists"]:
+            self.touch_projection(f"sim_graph_{record['community_id']}")
+        return record.data()
+
     def search_by_title(self, search, page=1, limit=24):
         search = search.lower().replace("  ", " ")
         skip = (page - 1) * limit if page > 1 else 0
@@ -182,8 +311,88 @@ class Neo4jStore:
                     "CALL gds.graph.drop($graph_name, False)", graph_name=graph_name
                 )
 
+        with self.projection_lock:
+            self.projection_last_used.clear()
+
+    def list_projections(self):
+        """
+        Returns the graphs in the GDS catalog with their size in bytes and
+        creation time (in seconds since the epoch).
+        """
+        with self.driver.session() as session:
+            result = session.run(
+                """
+                CALL gds.graph.list()
+                YIELD graphName, sizeInBytes, nodeCount, relationshipCount,
+                      creationTime
+                RETURN graphName AS name, sizeInBytes AS size,
+                       nodeCount AS nodes, relationshipCount AS rels,
+                       creationTime.epochMillis / 1000.0 AS created
+                """
+            )
+            return [record.data() for record in result]
+
+    def touch_projection(self, graph_name):
+        self.projection_last_used[graph_name] = time.time()
+
+    def reserve_projection_memory(self, required):
+        """
+        Drops similarity graph projections, least recently used first, until
+        ``required`` more bytes fit in the memory budget. Projections that are
+        being built are kept. Returns the names of the dropped projections.
+        """
+        if self.gds_memory_budget is None:
+            return []
+
+        with self.projection_lock:
+            projections = self.list_projections()
+            used = sum(x["size"] for x in projections)
+
+            # Projections not used by this process count as used when created
+            candidates = sorted(
+                (
+                    self.projection_last_used.get(x["name"], x["created"]),
+                    x["name"],
+                    x["size"],
+                )
+                for x in projections
+                if x["name"].startswith("sim_graph_")
+                and x["name"] not in self.projections_building
+            )
+
+            evicted = []
+            for _, graph_name, size in candidates:
+                if used + required <= self.gds_memory_budget:
+                    break
+                with self.driver.session() as session:
+                    _ = session.run(
+                        "CALL gds.graph.drop($graph_name, False)",
+                        graph_name=graph_name,
+                    )
+                self.projection_last_used.pop(graph_name, None)
+                self.projection_evictions += 1
+                self.projection_evicted_bytes += size
+                used -= size
+                evicted.append(graph_name)
+            return evicted
+
+    def projection_stats(self):
+        projections = self.list_projections()
+        with self.projection_lock:
+            for x in projections:
+                x["last_used"] = self.projection_last_used.get(x["name"])
+            return {
+                "budget_bytes": self.gds_memory_budget,
+                "used_bytes": sum(x["size"] for x in projections),
+                "evictions": self.projection_evictions,
+                "evicted_bytes": self.projection_evicted_bytes,
+                "building": sorted(self.projections_building),
+                "graphs": projections,
+            }
+
     def drop_similar_relationships(self):
         with self.driver.session() as session:
+            _ = session.run("MATCH (s:SimilarWritten) DELETE s")
             # Drop bib_community graph if exists
             result = session.run("MATCH ()-[r:SIMILAR]->() DETACH DELETE r")
             return result.data()
@@ -223,42 +432,102 @@ class Neo4jStore:
 
             return node_count, rel_count, community_count
 
-    def generate_candidates(self, pkey, k):
+    def has_similar_relationships(self, cid):
+        """
+        Whether the SIMILAR relationships of a community were completely
+        written; they outlive its projection, which is lost when Neo4j
+        restarts. build_similarity_graph marks a community once its write
+        finished, since GDS writes them in several transactions.
+        """
         with self.driver.session() as session:
-            # Retrieve community ID
             result = session.run(
-                "MATCH (p:Publication {key: $pkey}) RETURN p.community_id",
-                pkey=pkey,
+                """
+                OPTIONAL MATCH (s:SimilarWritten {cid: $cid})
+                RETURN s IS NOT NULL
+                """,
+                cid=cid,
             )
-            cid = result.single()[0]
-            sim_graph_name = f"sim_graph_{cid}"
+            return result.single()[0]
+
+    def _similarity_graph_queries(self, cid):
+        node_query = (
+            f"MATCH (n) WHERE n.community_id = {cid} "
+            "RETURN id(n) AS id, labels(n) AS labels"
+        )
+        relationship_query = (
+            "MATCH (n)-[r:CITED_BY|AUTHORED_BY|GROUPED_BY]-(m) "
+            f"WHERE n.community_id = {cid} AND m.community_id = {cid} "
+            "RETURN id(n) AS source, id(m) AS target, type(r) AS type"
+        )
+        return node_query, relationship_query
 
-            # Check if similiarity graph exists
+    def estimate_similarity_graph(self, cid):
+        """Returns the estimated size in bytes of the similarity graph."""
+        node_query, relationship_query = self._similarity_graph_queries(cid)
+
+        with self.driver.session() as session:
             result = session.run(
                 """
-                CALL gds.graph.exists($graph_name)
-                YIELD exists
-                RETURN exists
+                CALL gds.graph.project.cypher.estimate(
+                    $node_query,
+                    $relationship_query,
+                    {validateRelationships: False}
+                )
+                YIELD bytesMax
+                RETURN bytesMax
                 """,
-                graph_name=sim_graph_name,
+                node_query=node_query,
+                relationship_query=relationship_query,
             )
-            graph_exists = result.single()[0]
+            return result.single()[0]
+
+    def build_similarity_graph(self, cid):
+        """
+        Projects the similarity graph of a community and writes its SIMILAR
+        relationships with similarity scores. Least recently used projections
+        are dropped first to make room for it; the SIMILAR relationships
+        outlive them, so they need not be rebuilt. Relationships left by an
+        unfinished build are replaced.
+        """
+        sim_graph_name = f"sim_graph_{cid}"
+        node_query, relationship_query = self._similarity_graph_queries(cid)
+
+        self.reserve_projection_memory(self.estimate_similarity_graph(cid))
+        with self.projection_lock:
+            self.projections_building.add(sim_graph_name)
+
+        try:
+            with self.driver.session() as session:
+                _ = session.run(
+                    "MATCH (s:SimilarWritten {cid: $cid}) DELETE s", cid=cid
+                )
+                _ = session.run(
+                    """
+                    MATCH (:Publication {community_id: $cid})-[r:SIMILAR]->()
+                    CALL { WITH r DELETE r } IN TRANSACTIONS
+                    """,
+                    cid=cid,
+                )
+                _ = session.run(
+                    "CALL gds.graph.drop($graph_name, False)",
+                    graph_name=sim_graph_name,
+                )
 
-            # Generate similarity graph and SIMILAR relationships
-            if not graph_exists:
                 # Generate similarity graph for the given community id
                 _ = session.run(
-                    f"""
+                    """
                     CALL gds.graph.project.cypher(
-                        "{sim_graph_name}",
-                        "MATCH (n) WHERE n.community_id = {cid} RETURN id(n) AS id, labels(n) AS labels",
-                        "MATCH (n)-[r:CITED_BY|AUTHORED_BY|GROUPED_BY]-(m) WHERE n.community_id = {cid} AND m.community_id = {cid} RETURN id(n) AS source, id(m) AS target, type(r) AS type",
-                        {{
-                            validateRelationships: False
-                        }}
+                        $graph_name,
+                        $node_query,
+                        $relationship_query,
+                        {validateRelationships: False}
                     )
-                    YIELD graphName AS graph, nodeQuery, nodeCount AS nodes, relationshipCount AS rels
+                    YIELD graphName AS graph, nodeCount AS nodes,
+                          relationshipCount AS rels
                     """,
+                    graph_name=sim_graph_name,
+                    node_query=node_query,
+                    relationship_query=relationship_query,
                 )
 
                 # Create SIMILAR relationships with similarity scores
@@ -275,18 +544,61 @@ class Neo4jStore:
                     """,
                     graph_name=sim_graph_name,
                 )
+                _ = session.run("MERGE (:SimilarWritten {cid: $cid})", cid=cid)
+        finally:
+            with self.projection_lock:
+                self.projections_building.discard(sim_graph_name)
+
+        self.touch_projection(sim_graph_name)
+        # The estimate is an upper bound, but others may have been projected
+        self.reserve_projection_memory(0)
 
-            # Find top K candidates based on the similarity scores
+    def get_community_sizes(self):
+        """Returns (community id, number of publications), largest first."""
+        with self.driver.session() as session:
+            result = session.run(
+                """
+                MATCH (p:Publication)
+                WHERE p.community_id IS NOT NULL
+                RETURN p.community_id AS cid, COUNT(p) AS size
+                ORDER BY size DESC
+                """
+            )
+            return [(record["cid"], record["size"]) for record in result]
+
+    def get_community_members(self, cid):
+        with self.driver.session() as session:
+            result = session.run(
+                """
+                MATCH (p:Publication {community_id: $cid})
+                RETURN p.key AS pkey
+                ORDER BY pkey
+                """,
+                cid=cid,
+            )
+            return [record["pkey"] for record in result]
+
+    def get_similar_neighbours(self, cid, pkeys, k):
+        """
+        Returns the top k SIMILAR neighbours of each publication in ``pkeys``
+        (all in community ``cid``) as {pkey: [(neighbour pkey, score), ...]},
+        most similar first.
+        """
+        with self.driver.session() as session:
             result = session.run(
                 """
-                MATCH (p1:Publication {key: $pkey, community_id: $cid})-[r:SIMILAR]->(p2:Publication {community_id: $cid}) 
-                RETURN p2.key AS pkey, r.score AS node_similarity
-                ORDER BY r.score DESC 
-                LIMIT $k
+                MATCH (p:Publication {community_id: $cid})
+                WHERE p.key IN $pkeys
+                MATCH (p)-[r:SIMILAR]->(c:Publication {community_id: $cid})
+                WITH p, c, r.score AS score ORDER BY score DESC
+                WITH p, COLLECT([c.key, score])[..$k] AS neighbours
+                RETURN p.key AS pkey, neighbours
                 """,
-                pkey=pkey,
                 cid=cid,
+                pkeys=pkeys,
                 k=k,
             )
-
-            return [record.data() for record in result]
+            return {
+                record["pkey"]: [tuple(x) for x in record["neighbours"]]
+                for record in result
+            }
@@ -0,0 +1,86 @@
+"""
+COPY FROM STDIN payloads for (pkey, embed) rows.
+
+The binary format follows the PostgreSQL COPY BINARY layout: a signature
+header, one tuple per row (field count, then length-prefixed fields) and a
+trailer. Array columns are written in the binary array format, built with
+NumPy so no Python float is created per element.
+"""
+import io
+import struct
+
+import numpy as np
+
+from storage.embed_format import ARRAY_ELEMENTS, encode_embeds, vector_literal
+
+BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+BINARY_TRAILER = struct.pack(">h", -1)
+
+# Element type OIDs for the binary array format
+ARRAY_OIDS = {"float64": 701, "float32": 700}
+
+
+def _binary_array_fields(embeds, fmt):
+    oid, elem = ARRAY_OIDS[fmt], ARRAY_ELEMENTS[fmt]
+    n, dim = embeds.shape
+
+    # ndim, has_null, element oid, dimension size, lower bound
+    header = struct.pack(">iiiii", 1, 0, oid, dim, 1)
+    items = np.empty((n, dim), dtype=[("len", ">i4"), ("val", elem)])
+    items["len"] = elem.itemsize
+    items["val"] = embeds
+    return [header + row.tobytes() for row in items]
+
+
+def _text_escape(value):
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_payload(pkeys, embeds, fmt, binary=True):
+    """Returns a file-like object to pass to ``cursor.copy_expert``."""
+    embeds = np.asarray(embeds)
+    if embeds.ndim == 1:
+        embeds = embeds[np.newaxis, :]
+
+    buf = io.BytesIO()
+    if binary:
+        if fmt in ARRAY_ELEMENTS:
+            fields = _binary_array_fields(embeds, fmt)
+        else:
+            fields = encode_embeds(embeds, fmt)
+
+        buf.write(BINARY_SIGNATURE)
+        for pkey, field in zip(pkeys, fields):
+            key = pkey.encode("UTF-8")
+            buf.write(struct.pack(">hi", 2, len(key)))
+            buf.write(key)
+            buf.write(struct.pack(">i", len(field)))
+            buf.write(field)
+        buf.write(BINARY_TRAILER)
+    else:
+        if fmt in ARRAY_ELEMENTS:
+            values = ["{" + ",".join(map(repr, row)) + "}" for row in embeds.tolist()]
+        elif fmt == "vector":
+            values = [vector_literal(row) for row in embeds]
+        else:
+            values = ["\\\\x" + v.hex() for v in encode_embeds(embeds, fmt)]
+
+        for pkey, value in zip(pkeys, values):
+            buf.write(f"{_text_escape(pkey)}\t{value}\n".encode("UTF-8"))
+
+    buf.seek(0)
+    return buf
+
+
+def copy_embeds(cur, table, pkeys, embeds, fmt, binary=True, key_column="pkey"):
+    """Streams rows into ``table`` (key, embed) with COPY FROM STDIN."""
+    options = "(FORMAT binary)" if binary else "(FORMAT text)"
+    cur.copy_expert(
+        f"COPY {table} ({key_column}, embed) FROM STDIN {options}",
+        copy_payload(pkeys, embeds, fmt, binary),
+    )
@@ -1,4 +1,52 @@
+import functools
+import threading
+import time
+
+import numpy as np
 import psycopg2
+from psycopg2.extras import Json, execute_values
+
+from embedding.similarity import normalize as unit_normalize
+from storage.embed_format import (
+    COLUMN_TYPES,
+    check_format,
+    decode_packed,
+    packed_column,
+    vector_literal,
+)
+from storage.pgcopy import copy_embeds
+
+
+# Format of the embeds table as recorded by create_embed_table (see embed_format)
+_FORMAT_QUERY = """
+    SELECT COALESCE(
+        (SELECT value FROM meta WHERE key = 'embeds.format'), 'float64'
+    )
+"""
+
+
+def _serialized(method):
+    """
+    Runs a store method while holding the connection lock, so that threads
+    sharing the connection never interleave statements of different
+    transactions. A transaction left open by a read is ended afterwards, so
+    that no table lock outlives the call. This also resets psycopg2 after a
+    ``cur.execute("ROLLBACK")``, which it does not notice: it would not begin
+    the next transaction, and statements would run in autocommit.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            self._depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and not self.conn.closed:
+                    self.conn.rollback()
+
+    return wrapper
 
 
 class PostgresStore:
@@ -8,7 +56,22 @@ class PostgresStore:
         self.password = config["POSTGRES_PASS"]
         self.dbname = config["POSTGRES_DB"]
         self.port = config["POSTGRES_PORT"]
+        self.default_embed_format = check_format(config.get("EMBED_FORMAT", "float64"))
+        self._embed_format = None
+        self._embeds_normalized = None
+        self._title_embed_format = None
+        # Other processes may migrate the embeds table; its meta values are
+        # re-read after this many seconds, and after a failed read or write
+        self.embeds_meta_interval = config.get("EMBEDS_META_INTERVAL", 10.0)
+        self._embeds_meta_time = time.monotonic()
+        self.copy_binary = config.get("POSTGRES_COPY_BINARY", True)
+        # Index and search parameters of the vector format (pgvector)
+        self.vector_index = config.get("PGVECTOR_INDEX", "hnsw")
+        self.vector_ef_search = config.get("PGVECTOR_EF_SEARCH", 100)
+        self.vector_probes = config.get("PGVECTOR_PROBES", 10)
 
+        self.lock = threading.RLock()
+        self._depth = 0
         self.conn = self.get_db_conn()
 
     def __del__(self):
@@ -26,14 +89,310 @@ class PostgresStore:
     def close(self):
         self.conn.close()
 
-    def create_embed_table(self):
+    @_serialized
+    def create_meta_table(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                """
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+    @_serialized
+    def get_meta(self, key):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute("SELECT value FROM meta WHERE key = %s", (key,))
+            row = cur.fetchone()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return None
+
+        cur.close()
+        return row[0] if row else None
+
+    @_serialized
+    def set_meta(self, key, value):
         cur = self.conn.cursor()
+
         try:
             cur.execute(
                 """
+                INSERT INTO meta (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                """,
+                (key, value),
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+    @_serialized
+    def increment_meta(self, key):
+        """Atomically increments an integer meta value and returns it."""
+        cur = self.conn.cursor()
+        value = None
+
+        try:
+            cur.execute(
+                """
+                INSERT INTO meta (key, value) VALUES (%s, '1')
+                ON CONFLICT (key)
+                DO UPDATE SET value = (meta.value::BIGINT + 1)::TEXT
+                RETURNING value
+                """,
+                (key,),
+            )
+            value = int(cur.fetchone()[0])
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+        return value
+
+    @property
+    def embed_format(self):
+        """Storage format of the embeds table (see storage.embed_format)."""
+        self._expire_embeds_meta()
+        if self._embed_format is None:
+            # Tables created before formats were recorded use FLOAT8[]
+            self._embed_format = self.get_meta("embeds.format") or "float64"
+        return self._embed_format
+
+    @property
+    def title_embed_format(self):
+        """Storage format of the title_embeds cache table."""
+        if self._title_embed_format is None:
+            self._title_embed_format = self.get_meta("title_embeds.format") or "float64"
+        return self._title_embed_format
+
+    @property
+    def embeds_normalized(self):
+        """Whether all rows of the embeds table have unit L2 norm."""
+        self._expire_embeds_meta()
+        if self._embeds_normalized is None:
+            self._embeds_normalized = self.get_meta("embeds.normalized") == "true"
+        return self._embeds_normalized
+
+    def _expire_embeds_meta(self):
+        if time.monotonic() - self._embeds_meta_time >= self.embeds_meta_interval:
+            self._embeds_meta_time = time.monotonic()
+            self._embed_format = None
+            self._embeds_normalized = None
+
+    def _reload_embeds_meta(self):
+        """Re-reads the embeds meta values; returns whether the format changed."""
+        fmt = self._embed_format
+        self._embeds_meta_time = time.monotonic()
+        self._embed_format = None
+        self._embeds_normalized = None
+        return self.embed_format != fmt
+
+    @_serialized
+    def create_embed_table(self, fmt=None):
+        self.create_meta_table()
+        fmt = check_format(fmt or self.default_embed_format)
+
+        cur = self.conn.cursor()
+        try:
+            # An existing table keeps its format; use migrate_embed_format
+            cur.execute("SELECT to_regclass('embeds') IS NOT NULL")
+            normalized = "true"
+            if cur.fetchone()[0]:
+                fmt = self.get_meta("embeds.format") or "float64"
+                normalized = self.get_meta("embeds.normalized") or "false"
+
+            if fmt == "vector":
+                cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute(
+                f"""
                 CREATE TABLE IF NOT EXISTS embeds (
                     pkey TEXT PRIMARY KEY UNIQUE,
-                    embed FLOAT8[512]
+                    embed {COLUMN_TYPES[fmt]}
+                );
+                """
+            )
+            if fmt == "vector":
+                self._create_vector_index(cur, "embeds")
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+        self.set_meta("embeds.format", fmt)
+        self.set_meta("embeds.normalized", normalized)
+        self._embed_format = fmt
+        self._embeds_normalized = normalized == "true"
+
+    def _create_vector_index(self, cur, table):
+        """
+        Creates the similarity search index on a table in the vector format.
+        IVFFlat derives its number of lists from the rows present, so it is
+        best created after loading (migrate_embed_format does so).
+        """
+        if self.vector_index == "hnsw":
+            method = "hnsw (embed vector_cosine_ops)"
+        elif self.vector_index == "ivfflat":
+            cur.execute(f"SELECT count(*) FROM {table}")
+            lists = max(1, cur.fetchone()[0] // 1000)
+            method = f"ivfflat (embed vector_cosine_ops) WITH (lists = {lists})"
+        else:
+            return
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_embed_idx ON {table} USING {method}"
+        )
+
+    def migrate_embed_format(
+        self, fmt=None, batchsize=10000, progress=None, normalize=False
+    ):
+        """
+        Rewrites the embeds table in another storage format and/or with unit
+        normalized vectors. Rows are copied in batches into a new table while
+        the old one stays readable; rows written in the meantime are copied
+        under a lock right before the tables are swapped. Returns the number
+        of migrated rows.
+        """
+        self.create_meta_table()
+        src = self.embed_format
+        fmt = check_format(fmt or src)
+        normalized = self.embeds_normalized or normalize
+        if fmt == src and normalized == self.embeds_normalized:
+            return 0
+
+        read_conn = self.get_db_conn()
+        write_conn = self.get_db_conn()
+        count = 0
+
+        def copy_rows(cur_read, cur_write):
+            nonlocal count
+            while True:
+                rows = cur_read.fetchmany(batchsize)
+                if not rows:
+                    return
+                pkeys = [row[0] for row in rows]
+                embeds = decode_packed([row[1] for row in rows], src)
+                if normalized:
+                    embeds = unit_normalize(embeds)
+                copy_embeds(
+                    cur_write,
+                    "embeds_migrate",
+                    pkeys,
+                    embeds,
+                    fmt,
+                    binary=self.copy_binary,
+                )
+                count += len(rows)
+                if progress:
+                    progress(count)
+
+        try:
+            with write_conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS embeds_migrate")
+                if fmt == "vector":
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+                cur.execute(
+                    f"""
+                    CREATE TABLE embeds_migrate (
+                        pkey TEXT PRIMARY KEY,
+                        embed {COLUMN_TYPES[fmt]}
+                    )
+                    """
+                )
+            write_conn.commit()
+
+            with read_conn.cursor(name="migrate_embeds") as cur_read:
+                cur_read.itersize = batchsize
+                cur_read.execute(f"SELECT pkey, {packed_column(src)} FROM embeds")
+                with write_conn.cursor() as cur_write:
+                    copy_rows(cur_read, cur_write)
+                    if fmt == "vector":
+                        self._create_vector_index(cur_write, "embeds_migrate")
+            write_conn.commit()
+            # Release the snapshot and its lock on embeds before the swap
+            read_conn.commit()
+
+            # Catch up with rows inserted during the copy, then swap
+            with write_conn.cursor() as cur_write:
+                cur_write.execute("LOCK TABLE embeds IN EXCLUSIVE MODE")
+                with write_conn.cursor(name="migrate_embeds_rest") as cur_read:
+                    cur_read.execute(
+                        f"""
+                        SELECT e.pkey, {packed_column(src, "e.embed")} FROM embeds e
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM embeds_migrate m WHERE m.pkey = e.pkey
+                        )
+                        """
+                    )
+                    copy_rows(cur_read, cur_write)
+                cur_write.execute("DROP TABLE embeds")
+                cur_write.execute("ALTER TABLE embeds_migrate RENAME TO embeds")
+                cur_write.execute(
+                    "ALTER INDEX IF EXISTS embeds_migrate_embed_idx"
+                    " RENAME TO embeds_embed_idx"
+                )
+                cur_write.execute(
+                    """
+                    INSERT INTO meta (key, value) VALUES ('embeds.format', %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                    """,
+                    (fmt,),
+                )
+                cur_write.execute(
+                    """
+                    INSERT INTO meta (key, value) VALUES ('embeds.normalized', %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                    """,
+                    ("true" if normalized else "false",),
+                )
+            write_conn.commit()
+            self._embed_format = fmt
+            self._embeds_normalized = normalized
+        except Exception:
+            write_conn.rollback()
+            raise
+        finally:
+            read_conn.close()
+            write_conn.close()
+
+        return count
+
+    @_serialized
+    def create_title_embed_table(self):
+        """
+        Creates the title embedding cache in the format of the embeds table,
+        whose rows it is encoded for.
+        """
+        self.create_meta_table()
+        fmt = self.embed_format
+
+        cur = self.conn.cursor()
+        try:
+            # An existing table keeps its format
+            cur.execute("SELECT to_regclass('title_embeds') IS NOT NULL")
+            if cur.fetchone()[0]:
+                fmt = self.get_meta("title_embeds.format") or "float64"
+
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS title_embeds (
+                    title_hash TEXT PRIMARY KEY,
+                    embed {COLUMN_TYPES[fmt]}
                 );
                 """
             )
@@ -43,56 +402,742 @@ class PostgresStore:
             cur.execute("ROLLBACK")
         cur.close()
 
+        self.set_meta("title_embeds.format", fmt)
+        self._title_embed_format = fmt
+
+    @_serialized
+    def insert_title_embeds(self, title_hashes, embeds):
+        if not len(title_hashes):
+            return True
+
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                CREATE TEMP TABLE title_embeds_staging
+                (LIKE title_embeds)
+                ON COMMIT DROP
+                """
+            )
+            copy_embeds(
+                cur,
+                "title_embeds_staging",
+                title_hashes,
+                embeds,
+                self.title_embed_format,
+                binary=self.copy_binary,
+                key_column="title_hash",
+            )
+            cur.execute(
+                """
+                INSERT INTO title_embeds
+                SELECT * FROM title_embeds_staging
+                ON CONFLICT (title_hash)
+                DO NOTHING
+                """
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return False
+
+        cur.close()
+        return True
+
+    @_serialized
+    def retrieve_title_embeds(self, title_hashes):
+        """
+        Returns ``(hashes, matrix)`` for the cached titles among
+        ``title_hashes``, like retrieve_embed_matrix.
+        """
+        fmt = self.title_embed_format
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                f"""
+                SELECT title_hash, {packed_column(fmt)}
+                FROM title_embeds
+                WHERE title_hash = ANY(%s)
+                """,
+                (list(title_hashes),),
+            )
+            rows = cur.fetchall()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return [], decode_packed([], fmt)
+
+        cur.close()
+        return [row[0] for row in rows], decode_packed([row[1] for row in rows], fmt)
+
+    @_serialized
     def insert_pkeys_embeds(self, pkeys, embeds):
+        """
+        Bulk-inserts embeddings given as an (n, dim) array. Vectors are stored
+        with unit L2 norm, so similarities are plain dot products. Rows are
+        streamed with COPY into a temporary staging table and merged with a
+        single INSERT ... ON CONFLICT, so existing keys are left untouched.
+        """
+        if not len(pkeys):
+            return True
+        embeds = unit_normalize(embeds)
+        fmt = self.embed_format
+
         cur = self.conn.cursor()
-        data = list(zip(pkeys, embeds))
 
         try:
-            cur.executemany(
+            # Dropped on commit so that it follows the current column type
+            cur.execute(
+                """
+                CREATE TEMP TABLE embeds_staging
+                (LIKE embeds)
+                ON COMMIT DROP
+                """
+            )
+            # Binary COPY into BYTEA accepts any encoding, so make sure that
+            # no other process migrated the table to another format
+            cur.execute(_FORMAT_QUERY)
+            if cur.fetchone()[0] != fmt:
+                raise ValueError(f"The embeds table is no longer in {fmt} format")
+            copy_embeds(
+                cur,
+                "embeds_staging",
+                pkeys,
+                embeds,
+                fmt,
+                binary=self.copy_binary,
+            )
+            cur.execute(
                 """
                 INSERT INTO embeds
-                VALUES (%s, %s)
+                SELECT * FROM embeds_staging
                 ON CONFLICT (pkey)
                 DO NOTHING
+                """
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            # Retry once if another process migrated the table meanwhile
+            if self._reload_embeds_meta():
+                self.conn.rollback()
+                return self.insert_pkeys_embeds(pkeys, embeds)
+            return False
+
+        cur.close()
+        return True
+
+    @_serialized
+    def count_embeds(self):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute("SELECT COUNT(*) FROM embeds")
+            count = cur.fetchone()[0]
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return 0
+
+        cur.close()
+        return count
+
+    @_serialized
+    def filter_missing_pkeys(self, pkeys):
+        """Returns the given pkeys that do not have an embedding yet."""
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT k.pkey
+                FROM unnest(%s::TEXT[]) AS k(pkey)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM embeds e WHERE e.pkey = k.pkey
+                )
                 """,
-                data,
+                (list(pkeys),),
+            )
+            rows = cur.fetchall()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return list(pkeys)
+
+        cur.close()
+        return [row[0] for row in rows]
+
+    @_serialized
+    def create_checkpoint_table(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    job TEXT PRIMARY KEY,
+                    last_pkey TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                """
             )
             self.conn.commit()
         except Exception as e:
             print(e)
             cur.execute("ROLLBACK")
+        cur.close()
+
+    @_serialized
+    def get_checkpoint(self, job):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute("SELECT last_pkey FROM checkpoints WHERE job = %s", (job,))
+            row = cur.fetchone()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return None
 
         cur.close()
+        return row[0] if row else None
 
-    def retrieve_embeds(self, pkeys):
+    @_serialized
+    def set_checkpoint(self, job, last_pkey):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                INSERT INTO checkpoints (job, last_pkey)
+                VALUES (%s, %s)
+                ON CONFLICT (job)
+                DO UPDATE SET last_pkey = EXCLUDED.last_pkey, updated_at = now()
+                """,
+                (job, last_pkey),
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+
+        cur.close()
+
+    @_serialized
+    def clear_checkpoint(self, job):
         cur = self.conn.cursor()
 
         try:
-            if isinstance(pkeys, list):
+            cur.execute("DELETE FROM checkpoints WHERE job = %s", (job,))
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+
+        cur.close()
+
+    @_serialized
+    def create_neighbour_table(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS neighbours (
+                    pkey TEXT NOT NULL,
+                    rank SMALLINT NOT NULL,
+                    cand_pkey TEXT NOT NULL,
+                    node_sim REAL,
+                    content_sim REAL,
+                    PRIMARY KEY (pkey, rank)
+                );
+                """
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+    @_serialized
+    def replace_neighbours(self, pkeys, rows):
+        """
+        Replaces the neighbours of ``pkeys`` with ``rows`` of (pkey, rank,
+        cand_pkey, node_sim, content_sim).
+        """
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute("DELETE FROM neighbours WHERE pkey = ANY(%s)", (list(pkeys),))
+            execute_values(cur, "INSERT INTO neighbours VALUES %s", rows)
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return False
+
+        cur.close()
+        return True
+
+    @_serialized
+    def get_neighbours(self, pkey, k, epoch):
+        """
+        Returns the precomputed top k neighbours of a publication ordered by
+        rank, or None if the table was not computed for data ``epoch`` (see
+        ResultCache) or for a different k. The ranking depends on k (the top k
+        by node similarity are ordered by content), so a table computed for a
+        larger k cannot serve a smaller one.
+        """
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT m.epoch, m.k, n.cand_pkey, n.node_sim, n.content_sim
+                FROM (
+                    SELECT
+                        MAX(value) FILTER (WHERE key = 'neighbours.epoch') AS epoch,
+                        MAX(value) FILTER (WHERE key = 'neighbours.k') AS k
+                    FROM meta
+                ) m
+                LEFT JOIN LATERAL (
+                    SELECT cand_pkey, node_sim, content_sim
+                    FROM neighbours
+                    WHERE pkey = %s
+                    ORDER BY rank
+                    LIMIT %s
+                ) n ON true
+                """,
+                (pkey, k),
+            )
+            rows = cur.fetchall()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return None
+
+        cur.close()
+        fresh_epoch, fresh_k = rows[0][:2]
+        if fresh_epoch != str(epoch) or fresh_k is None or int(fresh_k) != k:
+            return None
+        return [
+            {"pkey": row[2], "node_similarity": row[3], "content_similarity": row[4]}
+            for row in rows
+            if row[2] is not None
+        ]
+
+    @_serialized
+    def create_job_table(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params JSONB,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    done BIGINT NOT NULL DEFAULT 0,
+                    total BIGINT,
+                    result JSONB,
+                    error TEXT,
+                    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    started_at TIMESTAMPTZ,
+                    finished_at TIMESTAMPTZ,
+                    owner TEXT,
+                    heartbeat_at TIMESTAMPTZ
+                );
+                """
+            )
+            # Tables created before jobs had owners
+            cur.execute(
+                """
+                ALTER TABLE jobs
+                ADD COLUMN IF NOT EXISTS owner TEXT,
+                ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ
+                """
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+    @_serialized
+    def insert_job(self, kind, params, owner=None):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                INSERT INTO jobs (kind, params, owner, heartbeat_at)
+                VALUES (%s, %s, %s, now())
+                RETURNING id
+                """,
+                (kind, Json(params), owner),
+            )
+            job_id = cur.fetchone()[0]
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return None
+
+        cur.close()
+        return job_id
+
+    @_serialized
+    def update_job(self, job_id, **fields):
+        """
+        Updates the given columns of a job and returns whether cancellation
+        has been requested for it.
+        """
+        cur = self.conn.cursor()
+        columns = ", ".join(f"{k} = %s" for k in fields)
+        values = [
+            Json(v) if k in ("params", "result") else v for k, v in fields.items()
+        ]
+
+        try:
+            cur.execute(
+                f"UPDATE jobs SET {columns} WHERE id = %s RETURNING cancel_requested",
+                (*values, job_id),
+            )
+            row = cur.fetchone()
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return False
+
+        cur.close()
+        return bool(row and row[0])
+
+    @_serialized
+    def start_job(self, job_id):
+        """Marks a queued job as running; returns False if it was cancelled."""
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                UPDATE jobs SET status = 'running', started_at = now()
+                WHERE id = %s AND status = 'queued' AND NOT cancel_requested
+                RETURNING id
+                """,
+                (job_id,),
+            )
+            row = cur.fetchone()
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return False
+
+        cur.close()
+        return row is not None
+
+    @_serialized
+    def finish_job(self, job_id, status, result=None, error=None):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = %s, result = %s, error = %s, finished_at = now()
+                WHERE id = %s
+                """,
+                (status, Json(result), error, job_id),
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+
+        cur.close()
+
+    @_serialized
+    def request_job_cancel(self, job_id):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET cancel_requested = TRUE,
+                    status = CASE WHEN status = 'queued'
+                        THEN 'cancelled' ELSE status END,
+                    finished_at = CASE WHEN status = 'queued'
+                        THEN now() ELSE finished_at END
+                WHERE id = %s AND status IN ('queued', 'running')
+                RETURNING id
+                """,
+                (job_id,),
+            )
+            row = cur.fetchone()
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return False
+
+        cur.close()
+        return row is not None
+
+    @_serialized
+    def heartbeat_jobs(self, owner):
+        """Records that the queued and running jobs of ``owner`` are alive."""
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                UPDATE jobs SET heartbeat_at = now()
+                WHERE owner = %s AND status IN ('queued', 'running')
+                """,
+                (owner,),
+            )
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+
+        cur.close()
+
+    @_serialized
+    def get_active_job_owners(self):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT DISTINCT owner FROM jobs
+                WHERE status IN ('queued', 'running') AND owner IS NOT NULL
+                """
+            )
+            rows = cur.fetchall()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return []
+
+        cur.close()
+        return [row[0] for row in rows]
+
+    @_serialized
+    def fail_stale_jobs(self, stale_after, dead_owners=()):
+        """
+        Marks queued or running jobs as failed if their owner is one of
+        ``dead_owners`` or sent no heartbeat for ``stale_after`` seconds.
+        Returns the ids of the failed jobs.
+        """
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                UPDATE jobs
+                SET status = 'failed', error = 'Interrupted', finished_at = now()
+                WHERE status IN ('queued', 'running')
+                AND (
+                    owner = ANY(%s)
+                    OR COALESCE(heartbeat_at, created_at)
+                        < now() - make_interval(secs => %s)
+                )
+                RETURNING id
+                """,
+                (list(dead_owners), stale_after),
+            )
+            rows = cur.fetchall()
+            self.conn.commit()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return []
+
+        cur.close()
+        return [row[0] for row in rows]
+
+    @_serialized
+    def get_job(self, job_id):
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT id, kind, params, status, done, total, result, error,
+                    cancel_requested, created_at, started_at, finished_at,
+                    EXTRACT(EPOCH FROM (COALESCE(finished_at, now()) - started_at))
+                        AS elapsed
+                FROM jobs
+                WHERE id = %s
+                """,
+                (job_id,),
+            )
+            columns = [desc[0] for desc in cur.description]
+            row = cur.fetchone()
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+            cur.close()
+            return None
+
+        cur.close()
+        return dict(zip(columns, row)) if row else None
+
+    def iter_embed_batches(self, batchsize=10000):
+        """
+        Streams the whole embeds table as ``(keys, matrix)`` batches ordered
+        by key, on a connection of its own so that the scan does not hold the
+        store lock.
+        """
+        fmt = self.embed_format
+        conn = self.get_db_conn()
+
+        try:
+            with conn.cursor(name="iter_embeds") as cur:
+                cur.itersize = batchsize
                 cur.execute(
-                    """
-                    SELECT pkey, embed
+                    f"""
+                    SELECT pkey, {packed_column(fmt)}
                     FROM embeds
-                    WHERE pkey IN %s
+                    WHERE embed IS NOT NULL
                     ORDER BY pkey
-                    """,
-                    (tuple(pkeys),),
+                    """
                 )
-            else:
+                while True:
+                    rows = cur.fetchmany(batchsize)
+                    if not rows:
+                        return
+                    keys = np.array([row[0] for row in rows], dtype=object)
+                    yield keys, decode_packed([row[1] for row in rows], fmt)
+        finally:
+            conn.close()
+
+    @_serialized
+    def nearest(self, target, k, exclude=None, within=None):
+        """
+        Returns the keys and cosine similarities of the ``k`` rows nearest to
+        ``target`` (a pkey or a vector), most similar first, computed in the
+        database. Without ``within`` the search uses the vector index and is
+        approximate; ``within`` restricts it to the given keys and is exact.
+        Keys in ``exclude`` and the target pkey itself are left out. Requires
+        the vector format (see migrate_embed_format).
+        """
+        if self.embed_format != "vector":
+            raise ValueError("nearest requires the vector embedding format")
+
+        exclude = list(exclude or [])
+        if isinstance(target, str):
+            query = "(SELECT embed FROM embeds WHERE pkey = %(target)s)"
+            exclude.append(target)
+        else:
+            query = "%(target)s::vector"
+            target = vector_literal(target)
+
+        # Materializing the candidates keeps the planner from scanning the
+        # vector index and filtering its (approximate) results afterwards
+        source = "embeds"
+        if within is not None:
+            source = """(
+                WITH candidates AS MATERIALIZED (
+                    SELECT pkey, embed FROM embeds WHERE pkey = ANY(%(within)s)
+                )
+                SELECT * FROM candidates
+            ) e"""
+
+        cur = self.conn.cursor()
+        keys, distances = [], []
+
+        try:
+            if self.vector_index == "hnsw":
                 cur.execute(
-                    """
-                    SELECT pkey, embed
-                    FROM embeds
-                    WHERE pkey = %s
-                    ORDER BY pkey
-                    """,
-                    (pkeys,),
+                    "SELECT set_config('hnsw.ef_search', %s, true)",
+                    (str(max(self.vector_ef_search, k)),),
+                )
+            elif self.vector_index == "ivfflat":
+                cur.execute(
+                    "SELECT set_config('ivfflat.probes', %s, true)",
+                    (str(self.vector_probes),),
                 )
+            cur.execute(
+                f"""
+                SELECT pkey, embed <=> {query} AS distance
+                FROM {source}
+                WHERE embed IS NOT NULL AND NOT (pkey = ANY(%(exclude)s))
+                ORDER BY distance
+                LIMIT %(k)s
+                """,
+                {"target": target, "exclude": exclude, "within": within, "k": k},
+            )
+            for key, distance in cur.fetchall():
+                keys.append(key)
+                distances.append(distance)
+        except Exception as e:
+            print(e)
+            cur.execute("ROLLBACK")
+        cur.close()
+
+        return keys, 1 - np.array(distances, dtype=np.float32)
+
+    @_serialized
+    def retrieve_embed_matrix(self, pkeys):
+        """
+        Fetches the embeddings of the given keys as one contiguous float32
+        matrix. Returns ``(keys, matrix)`` where ``keys`` is an array of the
+        keys found, in the order of the matrix rows.
+        """
+        fmt = self.embed_format
+        cur = self.conn.cursor()
+
+        try:
+            # The format is read in the same snapshot as the rows
+            cur.execute(
+                f"""
+                SELECT pkey, {packed_column(fmt)}, ({_FORMAT_QUERY})
+                FROM embeds
+                WHERE pkey = ANY(%s) AND embed IS NOT NULL
+                ORDER BY pkey
+                """,
+                (list(pkeys),),
+            )
             rows = cur.fetchall()
+            if rows and rows[0][2] != fmt:
+                raise ValueError(f"The embeds table is no longer in {fmt} format")
         except Exception as e:
             print(e)
             cur.execute("ROLLBACK")
-            return []
+            cur.close()
+            if self._reload_embeds_meta():
+                return self.retrieve_embed_matrix(pkeys)
+            return np.array([], dtype=object), decode_packed([], fmt)
 
         cur.close()
-        return rows
+        keys = np.array([row[0] for row in rows], dtype=object)
+        return keys, decode_packed([row[1] for row in rows], fmt)
+
+    @_serialized
+    def retrieve_embeds(self, pkeys):
+        if not isinstance(pkeys, list):
+            pkeys = [pkeys]
+
+        keys, embeds = self.retrieve_embed_matrix(pkeys)
+        return list(zip(keys, embeds))
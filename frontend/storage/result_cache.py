@@ -0,0 +1,177 @@
+import contextlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+EPOCH_KEY = "data.epoch"
+
+
+class ResultCache:
+    """
+    Cache of computed results (e.g. recommendations) in two tiers: a bounded
+    in-process LRU with a TTL and, if ``RESULT_CACHE_PATH`` is set, a SQLite
+    file shared by all processes of the app.
+
+    Entries are tagged with the data epoch, a counter in the Postgres meta
+    table that ``bump_epoch`` increments whenever the graph or embeddings
+    change; entries of an older epoch are never returned. Processes re-read
+    the epoch at most every ``RESULT_CACHE_EPOCH_INTERVAL`` seconds.
+    """
+
+    def __init__(self, config, store_postgres):
+        self.store_postgres = store_postgres
+        self.max_entries = config.get("RESULT_CACHE_SIZE", 1024)
+        self.ttl = config.get("RESULT_CACHE_TTL", 3600)
+        self.path = config.get("RESULT_CACHE_PATH", None)
+        self.max_disk_entries = config.get("RESULT_CACHE_DISK_SIZE", 100000)
+        self.epoch_interval = config.get("RESULT_CACHE_EPOCH_INTERVAL", 1.0)
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self._epoch = None
+        self._epoch_read_at = 0.0
+        self._disk_puts = 0
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS results (
+                        key TEXT PRIMARY KEY,
+                        epoch INTEGER,
+                        expires REAL,
+                        value BLOB
+                    )
+                    """
+                )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @property
+    def epoch(self):
+        """The current data epoch."""
+        now = time.monotonic()
+        if self._epoch is None or now - self._epoch_read_at > self.epoch_interval:
+            epoch = int(self.store_postgres.get_meta(EPOCH_KEY) or 0)
+            with self.lock:
+                if self._epoch is not None and epoch != self._epoch:
+                    self.counters["invalidations"] += 1
+                    self.entries.clear()
+                self._epoch, self._epoch_read_at = epoch, now
+        return self._epoch
+
+    def bump_epoch(self):
+        """Invalidates all entries, in every process."""
+        self.store_postgres.create_meta_table()
+        epoch = self.store_postgres.increment_meta(EPOCH_KEY)
+        with self.lock:
+            self.counters["invalidations"] += 1
+            self.entries.clear()
+            self._epoch, self._epoch_read_at = epoch, time.monotonic()
+
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM results WHERE epoch < ?", (epoch,))
+        return epoch
+
+    def get(self, key, epoch):
+        """Returns the value cached for ``key`` in ``epoch``, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == epoch and entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry[2]
+                del self.entries[key]
+                self.counters["expired"] += 1
+
+        if self.path:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT expires, value FROM results WHERE key = ? AND epoch = ?",
+                    (key, epoch),
+                ).fetchone()
+            if row is not None and row[0] > now:
+                value = pickle.loads(row[1])
+                self._put_memory(key, value, epoch, row[0])
+                with self.lock:
+                    self.counters["disk_hits"] += 1
+                return value
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, value, epoch):
+        """
+        Caches ``value`` for ``key``; ``epoch`` is the data epoch read before
+        the value was computed, so results of data replaced in the meantime
+        are never served.
+        """
+        expires = time.time() + self.ttl
+        self._put_memory(key, value, epoch, expires)
+
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (key, epoch, expires, pickle.dumps(value)),
+                )
+                self._disk_puts += 1
+                if self._disk_puts % 100 == 0:
+                    self._prune_disk(conn)
+
+    def _put_memory(self, key, value, epoch, expires):
+        with self.lock:
+            self.entries[key] = (epoch, expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def _prune_disk(self, conn):
+        conn.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+        conn.execute(
+            """
+            DELETE FROM results WHERE key IN (
+                SELECT key FROM results ORDER BY expires DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_disk_entries,),
+        )
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, size=len(self.entries), epoch=self._epoch)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["hits"] + stats["disk_hits"]) / lookups if lookups else None
+        )
+        if self.path:
+            with self._connect() as conn:
+                stats["disk_size"] = conn.execute(
+                    "SELECT count(*) FROM results"
+                ).fetchone()[0]
+        return stats